@@ -1,14 +1,14 @@
 #!/bin/bash
-# Start Qdrant in ephemeral mode
-qdrant &
+# Start Qdrant with on-disk storage so collections survive restarts and
+# unchanged doc sets are not re-ingested on boot. The default path is a
+# VOLUME in the Dockerfile; a custom QDRANT_STORAGE_PATH must be a
+# persistent mount as well. Not needed when the backend searches in process
+# (VECTOR_STORE_BACKEND=embedded).
+if [ "${VECTOR_STORE_BACKEND:-qdrant}" = "qdrant" ]; then
+  export QDRANT__STORAGE__STORAGE_PATH="${QDRANT_STORAGE_PATH:-/app/qdrant_storage}"
+  qdrant &
+fi
 
-# Wait until Qdrant is ready
-echo "Waiting for Qdrant to initialize..."
-until curl -s http://127.0.0.1:6333/collections >/dev/null; do
-  echo "Qdrant is not ready yet, waiting..."
-  sleep 10
-done
-echo "Qdrant is up and running!"
-
-# Start RAG application
+# Start RAG application right away; it waits for Qdrant and loads the
+# collections in the background, see /health/ready
 uv run start-backend
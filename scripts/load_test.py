@@ -0,0 +1,134 @@
+"""
+Concurrent load test for the chat endpoints
+
+Sends `--requests` chat messages, `--concurrency` at a time, and reports the
+latency of each request and how much the requests overlapped. With awaited
+agent runs the wall time approaches the latency of one request per wave;
+a server that handles one chat at a time shows a wall time close to the
+sum of all latencies and an overlap factor of about 1.
+
+Against a running server:
+
+    python scripts/load_test.py --url http://localhost:8080
+
+Without a server or API keys, `--in-process` serves the app through ASGI
+with the agents replaced by a model that takes `--model-latency` seconds
+to answer, and the query embeddings already cached:
+
+    python scripts/load_test.py --in-process --requests 20 --concurrency 10
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from contextlib import ExitStack
+
+import httpx
+
+
+def _message(index: int) -> str:
+    return f"What is Flare? ({index})"
+
+
+async def _send(client: httpx.AsyncClient, path: str, index: int, start: float) -> tuple[float, float, int]:
+    sent = time.perf_counter() - start
+    response = await client.post(path, json={"message": _message(index)})
+    return sent, time.perf_counter() - start, response.status_code
+
+
+async def run_load(client: httpx.AsyncClient, path: str, num_requests: int, concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+
+    async def limited(index: int) -> tuple[float, float, int]:
+        async with semaphore:
+            return await _send(client, path, index, start)
+
+    results = await asyncio.gather(*(limited(index) for index in range(num_requests)))
+    wall_time = time.perf_counter() - start
+
+    latencies = [finished - sent for sent, finished, _ in results]
+    statuses: dict[int, int] = {}
+    for _, _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    # Largest number of requests in flight at the same time
+    events = sorted(
+        [(sent, 1) for sent, _, _ in results] + [(finished, -1) for _, finished, _ in results],
+        key=lambda event: (event[0], event[1]),
+    )
+    in_flight = max_in_flight = 0
+    for _, delta in events:
+        in_flight += delta
+        max_in_flight = max(max_in_flight, in_flight)
+
+    print(f"requests:        {num_requests} ({concurrency} concurrent)")
+    print(f"status codes:    {statuses}")
+    print(f"wall time:       {wall_time:.2f}s")
+    print(f"latency p50:     {statistics.median(latencies):.2f}s")
+    print(f"latency max:     {max(latencies):.2f}s")
+    print(f"sum of latency:  {sum(latencies):.2f}s")
+    print(f"overlap factor:  {sum(latencies) / wall_time:.2f}")
+    print(f"max in flight:   {max_in_flight}")
+
+
+async def run_in_process(args: argparse.Namespace) -> None:
+    os.environ.setdefault("GEMINI_API_KEY", "load-test")
+    os.environ.setdefault("OPENAI_API_KEY", "load-test")
+    os.environ.setdefault("VECTOR_STORE_BACKEND", "embedded")
+    os.environ.setdefault("EMBEDDING_STORE_PATH", "")
+    # Every request should reach the model
+    os.environ.setdefault("RESPONSE_CACHE_SIZE", "0")
+
+    from pydantic_ai.messages import ModelResponse, TextPart
+    from pydantic_ai.models.function import FunctionModel
+
+    from flava_ai_new.corpus import EMBEDDING_VECTOR_SIZE
+    from flava_ai_new.embedding import EMBEDDING_MODEL, query_embedding_cache
+    from flava_ai_new.main import create_app
+
+    async def slow_model(messages, info) -> ModelResponse:
+        await asyncio.sleep(args.model_latency)
+        return ModelResponse(parts=[TextPart("Flare is the blockchain for data.")])
+
+    app = create_app()
+    # The query router embeds the query before the first model turn
+    for index in range(args.requests):
+        query_embedding_cache.put(EMBEDDING_MODEL, _message(index), [1.0] * EMBEDDING_VECTOR_SIZE)
+    chat_router = app.state.chat_router
+    if args.path.rstrip("/").endswith("consensus"):
+        agents = chat_router.consensus_agent.agents
+    else:
+        agents = [chat_router.agent]
+
+    with ExitStack() as stack:
+        for agent in agents:
+            stack.enter_context(agent.override(model=FunctionModel(slow_model)))
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=None) as client:
+            await run_load(client, args.path, args.requests, args.concurrency)
+
+
+async def run_remote(args: argparse.Namespace) -> None:
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        await run_load(client, args.path, args.requests, args.concurrency)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:8080", help="Base URL of the backend.")
+    parser.add_argument("--path", default="/api/routes/chat/", help="Chat endpoint to call.")
+    parser.add_argument("--requests", type=int, default=20, help="Number of requests to send.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once.")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout per request in seconds.")
+    parser.add_argument("--in-process", action="store_true", help="Serve the app in process with a fake model.")
+    parser.add_argument("--model-latency", type=float, default=1.0, help="Seconds the fake model takes to answer.")
+    args = parser.parse_args()
+
+    asyncio.run(run_in_process(args) if args.in_process else run_remote(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -57,6 +57,11 @@ Generate an answer to the user query based solely on the given context. Provide
 The generated response should be in notion markdown format.
 """
 
+# Added to the system prompt of the fast agent of the model cascade
+CASCADE_CONFIDENCE_PROMPT = """
+Along with the answer, report how confident you are that it is correct and fully supported by the documentation or tool results you retrieved, from 0 to 1. Report a low confidence when the retrieved documentation does not clearly cover the question, when you had to guess, or when the question needs reasoning over several sources. Do not overstate it: a lower confidence hands the question to a stronger model.
+"""
+
 # If an agent tool has been used add "Agent Tool Used": < tool-name> to the end of the response.
 
 
@@ -2,41 +2,46 @@
 Tools that agents can use
 """
 
+import asyncio
+
 import requests
 from datetime import datetime, timezone
 import structlog
 from pydantic_ai import RunContext
 
 
-from .qdrant import semantic_search
+from .agents import VALIDATOR_API_TIMEOUT
+from .qdrant import semantic_search_async
+from .retrieval import RetrievalContext
+from .vector_store import VectorStore
 
 logger = structlog.get_logger(__name__)
 
 
-def retrieve_flare_network_documentation(ctx: RunContext[str], qdrant_client):
+async def retrieve_flare_network_documentation(ctx: RunContext[RetrievalContext], vector_store: VectorStore):
     """
         Retrieves flare network documentation.
 
         Add "Agent tool used: retrieve-flare-network-documentation" to the end of the message.
         """
-    retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                     query=ctx.deps, collection_name="flare-network", top_k=8
-                                     )
+    retrieved_docs = await semantic_search_async(vector_store=vector_store,
+                                                 query=ctx.deps.query, query_vector=await ctx.deps.query_vector(), collection_name="flare-network", top_k=8
+                                                 )
 
     # print(retrieved_docs)
     logger.info("Documents retrieved for flare-network")
     return retrieved_docs
 
 
-def retrieve_blaze_swap_documentation(ctx: RunContext[str], qdrant_client):
+async def retrieve_blaze_swap_documentation(ctx: RunContext[RetrievalContext], vector_store: VectorStore):
     """
     Retrieves blaze swap documentation.
 
     Add "Agent tool used: retrieve-blaze-swap-documentation" to the end of the message.
     """
-    retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                     query=ctx.deps, collection_name="blaze-swap", top_k=5
-                                     )
+    retrieved_docs = await semantic_search_async(vector_store=vector_store,
+                                                 query=ctx.deps.query, query_vector=await ctx.deps.query_vector(), collection_name="blaze-swap", top_k=5
+                                                 )
 
     # print(retrieved_docs)
     logger.info("Documents retrieved for blaze-swap")
@@ -67,7 +72,7 @@ async def get_validator_info():
     url = "https://api.flaremetrics.io/v2/network/validators/flare/stakes"
 
     try:
-        response = requests.get(url)
+        response = await asyncio.to_thread(requests.get, url, timeout=VALIDATOR_API_TIMEOUT)
         response.raise_for_status()  # Raise an error for bad responses (4xx, 5xx)
 
         data = response.json()  # Convert response to JSON
@@ -99,4 +104,4 @@ async def get_validator_info():
         # print(all_validators)
         return all_validators
     except requests.exceptions.RequestException as e:
-        print(f"Error: {e}")
+        logger.warning("Fetching validator info failed", error=str(e))
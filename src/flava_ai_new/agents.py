@@ -2,91 +2,184 @@
 """
 Sets up pydantic agents - RAG and consensus
 """
+import asyncio
+import os
+import re
+from dataclasses import replace
+
 import structlog
 
-from pydantic_ai import Agent, RunContext
+from pydantic_ai import Agent, ModelRetry, RunContext
+from pydantic_ai.tools import ToolDefinition
 import requests
 from datetime import datetime, timezone
 
 
-from .PROMPTS import AGENT_SYSTEM_PROMPT, CONSENSUS_MAIN_AGENT_PROMPT, CONSENSUS_SUB_AGENT_PROMPT
+from .collection_status import CollectionRegistry
+from .cascade import CASCADE_FAST_MODEL, CascadeAgent, CascadeAnswer
+from .consensus import CONSENSUS_AGENT_TIMEOUT, ConsensusAgent, SubAgent, format_sub_agent_results
+from .PROMPTS import (
+    AGENT_SYSTEM_PROMPT,
+    CASCADE_CONFIDENCE_PROMPT,
+    CONSENSUS_MAIN_AGENT_PROMPT,
+    CONSENSUS_SUB_AGENT_PROMPT,
+)
 
 # from .agent_tools import retrieve_blaze_swap_documentation, retrieve_flare_network_documentation, get_validator_info
-from .qdrant import semantic_search
+from .query_router import KeywordRule, QueryRouter
+from .retrieval import RetrievalContext
+from .vector_store import VectorStore
 
 logger = structlog.get_logger(__name__)
 
-
-def setup_pydantic_agent(qdrant_client):
-    agent = Agent(
-        'google-gla:gemini-2.0-pro-exp-02-05',
-        system_prompt=AGENT_SYSTEM_PROMPT,
-        deps_type=None,
-        retries=2
-    )
-
-    @agent.tool
-    def retrieve_flare_network_documentation(ctx: RunContext[str]):
-        """
-            Retrieves flare network documentation.
-
-            Add "Agent tool used: retrieve-flare-network-documentation" to the end of the message.
-            """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="flare-network", top_k=8
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for flare-network")
-        return retrieved_docs
-
-    @agent.tool
-    def retrieve_blaze_swap_documentation(ctx: RunContext[str]):
-        """
-        Retrieves blaze swap documentation.
-
-        Add "Agent tool used: retrieve-blaze-swap-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="blaze-swap", top_k=5
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for blaze-swap")
+# Documentation sets the agents can search, and the collection holding each
+DOCUMENTATION_COLLECTIONS = {
+    "flare-network": "flare-network",
+    "blaze-swap": "blaze-swap",
+    "spark-dex": "spark-dex_semantic",
+    "rain-dex": "rain-dex_semantic",
+}
+
+VALIDATOR_TOOL = "get_validator_info"
+# Seconds to wait for the validator API
+VALIDATOR_API_TIMEOUT = float(os.getenv("VALIDATOR_API_TIMEOUT", "10"))
+
+# Keyword rules of the query router, for names and topics the centroid
+# scores alone may not single out
+ROUTING_RULES = [
+    KeywordRule(re.compile(r"blaze\s*swap", re.IGNORECASE),
+                collections=(DOCUMENTATION_COLLECTIONS["blaze-swap"],)),
+    KeywordRule(re.compile(r"spark\s*dex", re.IGNORECASE),
+                collections=(DOCUMENTATION_COLLECTIONS["spark-dex"],)),
+    KeywordRule(re.compile(r"rain\s*dex", re.IGNORECASE),
+                collections=(DOCUMENTATION_COLLECTIONS["rain-dex"],)),
+    KeywordRule(re.compile(r"\b(ftso|fdc|f-?assets?|songbird|w?flr)\b", re.IGNORECASE),
+                collections=(DOCUMENTATION_COLLECTIONS["flare-network"],)),
+    KeywordRule(re.compile(r"\b(validators?|node\s*-?ids?|delegat\w*|stak\w*|uptime)\b", re.IGNORECASE),
+                tools=(VALIDATOR_TOOL,)),
+]
+
+
+def add_documentation_tool(
+    agent: Agent,
+    vector_store: VectorStore,
+    collection_registry: CollectionRegistry,
+    documentation_sets: list[str],
+    top_k: int = 8,
+    query_router: QueryRouter | None = None,
+) -> None:
+    """
+    Register a single `retrieve_documentation` tool that searches any of the
+    given documentation sets with one federated search, so that the model can
+    cover several sets in one tool call.
+
+    With a query router, the tool description names the sets the router
+    picked for the query, and those are searched when the model does not
+    name any.
+
+    Args:
+        agent (Agent): Agent to register the tool on.
+        vector_store (VectorStore): Store holding the documentation collections.
+        collection_registry (CollectionRegistry): Loading state of the collections.
+        documentation_sets (list[str]): Keys of DOCUMENTATION_COLLECTIONS the agent may search.
+        top_k (int): Number of chunks returned across all searched sets.
+        query_router (QueryRouter | None): Picks the sets relevant to the query.
+    """
+
+    async def routed_sets(deps: RetrievalContext) -> list[str]:
+        if query_router is None:
+            return documentation_sets
+        route = query_router.route(
+            deps.question, await deps.question_vector(),
+            [DOCUMENTATION_COLLECTIONS[name] for name in documentation_sets])
+        return [name for name in documentation_sets if DOCUMENTATION_COLLECTIONS[name] in route.collections]
+
+    async def retrieve_documentation(ctx: RunContext[RetrievalContext], documentation: list[str] | None = None):
+        requested = documentation or await routed_sets(ctx.deps)
+        unknown = [name for name in requested if name not in documentation_sets]
+        if unknown:
+            msg = f"Unknown documentation sets {unknown}, choose from {documentation_sets}"
+            raise ModelRetry(msg)
+
+        ctx.deps.notify("tool_call", {"tool": "retrieve_documentation", "documentation": list(requested)})
+
+        collection_names = [DOCUMENTATION_COLLECTIONS[name] for name in requested]
+        ready = collection_registry.ready_collections(collection_names)
+        if len(ready) < len(collection_names):
+            logger.warning(
+                "Skipping collections that are not ready",
+                collections=[name for name in collection_names if name not in ready],
+            )
+
+        retrieved_docs = await ctx.deps.federated_search(vector_store, ready, top_k)
+
+        logger.info("Documents retrieved", collections=ready)
         return retrieved_docs
 
-    @agent.tool
-    def retrieve_spark_dex_documentation(ctx: RunContext[str]):
-        """
-        Retrieves spark dex documentation.
-
-        Add "Agent tool used: retrieve-spark-dex-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="spark-dex_semantic", top_k=5
-                                         )
+    retrieve_documentation.__doc__ = f"""
+        Retrieves documentation from one or more documentation sets in a single search.
 
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for spark-dex")
-        return retrieved_docs
+        For every documentation set searched, add "Agent tool used: retrieve-<documentation set>-documentation" to the end of the message.
 
-    @agent.tool
-    def retrieve_rain_dex_documentation(ctx: RunContext[str]):
+        Args:
+            documentation: Documentation sets to search, any of {", ".join(documentation_sets)}. Searches all of them when omitted.
         """
-        Retrieves rain dex documentation.
 
-        Add "Agent tool used: retrieve-rain-dex-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="rain-dex_semantic", top_k=5
-                                         )
+    async def suggest_sets(ctx: RunContext[RetrievalContext], tool_def: ToolDefinition) -> ToolDefinition:
+        try:
+            suggested = await routed_sets(ctx.deps)
+        except Exception as e:
+            # Only a hint: the tool itself reports retrieval failures
+            logger.warning("Routing the query failed", error=str(e))
+            return tool_def
+        if len(suggested) == len(documentation_sets):
+            return tool_def
+        return replace(
+            tool_def,
+            description=f"{tool_def.description}\n\nMost relevant to this question: {', '.join(suggested)}.",
+        )
+
+    agent.tool(retrieve_documentation, prepare=suggest_sets if query_router is not None else None)
+
+
+def hint_when_routed(query_router: QueryRouter, tool_name: str):
+    """
+    Tool prepare function pointing the model at the tool when the query
+    router's keyword rules select it for the question. The tool is offered
+    either way, since keywords miss questions such as a validator named
+    without the word "validator".
+    """
+
+    async def prepare(ctx: RunContext[RetrievalContext], tool_def: ToolDefinition) -> ToolDefinition:
+        route = query_router.route(ctx.deps.question, None, [])
+        if tool_name not in route.tools:
+            return tool_def
+        return replace(tool_def, description=f"{tool_def.description}\n\nThis question likely needs this tool.")
+
+    return prepare
+
+
+def setup_pydantic_agent(
+    vector_store: VectorStore,
+    collection_registry: CollectionRegistry,
+    query_router: QueryRouter | None = None,
+    model: str = 'google-gla:gemini-2.0-pro-exp-02-05',
+    system_prompt: str = AGENT_SYSTEM_PROMPT,
+    result_type: type = str,
+):
+    agent = Agent(
+        model,
+        system_prompt=system_prompt,
+        deps_type=RetrievalContext,
+        result_type=result_type,
+        retries=2
+    )
 
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for rain-dex")
-        return retrieved_docs
+    add_documentation_tool(agent, vector_store, collection_registry,
+                           list(DOCUMENTATION_COLLECTIONS), query_router=query_router)
 
-    @agent.tool_plain
-    async def get_validator_info():
+    @agent.tool(prepare=hint_when_routed(query_router, VALIDATOR_TOOL) if query_router is not None else None)
+    async def get_validator_info(ctx: RunContext[RetrievalContext]):
         """
         Retrieve information about validators in the flare network. If any specific information about the validator is asked use this tool. Like if a user names a validator and asks questions about it.
 
@@ -107,10 +200,12 @@ def setup_pydantic_agent(qdrant_client):
         Add "Agent tool used: get-validator-info" to the end of the message.
         """
 
+        ctx.deps.notify("tool_call", {"tool": "get_validator_info"})
+
         url = "https://api.flaremetrics.io/v2/network/validators/flare/stakes"
 
         try:
-            response = requests.get(url)
+            response = await asyncio.to_thread(requests.get, url, timeout=VALIDATOR_API_TIMEOUT)
             response.raise_for_status()  # Raise an error for bad responses (4xx, 5xx)
 
             data = response.json()  # Convert response to JSON
@@ -142,146 +237,89 @@ def setup_pydantic_agent(qdrant_client):
             # print(all_validators)
             return all_validators
         except requests.exceptions.RequestException as e:
-            print(f"Error: {e}")
+            logger.warning("Fetching validator info failed", error=str(e))
 
     return agent
 
 
-def setup_pydantic_consensus_agent(qdrant_client):
+def setup_pydantic_cascade_agent(
+    vector_store: VectorStore,
+    collection_registry: CollectionRegistry,
+    strong_agent: Agent,
+    query_router: QueryRouter | None = None,
+) -> CascadeAgent:
+    """
+    Cascade from a fast agent with the same tools as `strong_agent`, which
+    reports the confidence of its answers, to `strong_agent` itself.
+    """
+    fast_agent = setup_pydantic_agent(
+        vector_store,
+        collection_registry,
+        query_router,
+        model=CASCADE_FAST_MODEL,
+        system_prompt=AGENT_SYSTEM_PROMPT + CASCADE_CONFIDENCE_PROMPT,
+        result_type=CascadeAnswer,
+    )
+    return CascadeAgent(fast=fast_agent, strong=strong_agent)
+
+
+def setup_pydantic_consensus_agent(vector_store: VectorStore, collection_registry: CollectionRegistry) -> ConsensusAgent:
     main_agent = Agent(
         'google-gla:gemini-2.0-pro-exp-02-05',
         system_prompt=CONSENSUS_MAIN_AGENT_PROMPT,
-        deps_type=None,
+        deps_type=RetrievalContext,
         retries=1
     )
 
     agent_1 = Agent(
         'google-gla:gemini-2.0-flash',
         system_prompt=CONSENSUS_SUB_AGENT_PROMPT,
-        deps_type=None,
+        deps_type=RetrievalContext,
         retries=1
     )
 
     agent_2 = Agent(
         'google-gla:gemini-1.5-flash-8b',
         system_prompt=CONSENSUS_SUB_AGENT_PROMPT,
-        deps_type=None,
+        deps_type=RetrievalContext,
         retries=1
     )
 
     agent_3 = Agent(
         'openai:gpt-4o-mini',
         system_prompt=CONSENSUS_SUB_AGENT_PROMPT,
-        deps_type=None,
+        deps_type=RetrievalContext,
         retries=1
     )
 
     agent_4 = Agent(
         'openai:o3-mini',
         system_prompt=CONSENSUS_SUB_AGENT_PROMPT,
-        deps_type=None,
+        deps_type=RetrievalContext,
         retries=1
     )
 
+    sub_agents = [
+        SubAgent(f"Agent {number}", sub_agent,
+                 float(os.getenv(f"CONSENSUS_TIMEOUT_{number}", CONSENSUS_AGENT_TIMEOUT)))
+        for number, sub_agent in enumerate([agent_1, agent_2, agent_3, agent_4], start=1)
+    ]
+
     @main_agent.tool
-    async def get_multiple_responses(ctx: RunContext[str]):
+    async def get_multiple_responses(ctx: RunContext[RetrievalContext]):
         """
         You get multiple responses from multiple agents
         """
         logger.info("Getting multiple responses")
-        # first argument is message passesd to this, second argument is message that it passes to its tools
-        r1 = await agent_1.run(ctx.deps, deps=ctx.deps)
-        r2 = await agent_2.run(ctx.deps, deps=ctx.deps)
-        r3 = await agent_3.run(ctx.deps, deps=ctx.deps)
-        r4 = await agent_4.run(ctx.deps, deps=ctx.deps)
-
-        print(r1.data)
-        print(r2.data)
-        print(r3.data)
-        print(r4.data)
-
-        return f"""
-        Agent 1 response:
-        
-        {r1.data}\n\n
-        
-        Agent 2 response:
-        
-        {r2.data}\n\n
-        
-        Agent 3 response:
-        
-        {r3.data}\n\n
-        
-        Agent 4 response:
-        
-        {r4.data}\n\n
-        """
+        # Runs the sub-agents once per request, sharing the retrieval context
+        # so they reuse the same query embedding and searches
+        results = await consensus.collect(ctx.deps)
+        return format_sub_agent_results(results)
 
     ###########################################################
     ###################### AGENT 1 TOOLS ######################
     ###########################################################
 
-    @agent_1.tool
-    def retrieve_flare_network_documentation_1(ctx: RunContext[str]):
-        """
-            Retrieves flare network documentation.
-
-            Add "Agent tool used: retrieve-flare-network-documentation" to the end of the message.
-            """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="flare-network", top_k=8
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for flare-network")
-        return retrieved_docs
-
-    @agent_1.tool
-    def retrieve_blaze_swap_documentation_1(ctx: RunContext[str]):
-        """
-        Retrieves blaze swap documentation.
-
-        Add "Agent tool used: retrieve-blaze-swap-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="blaze-swap", top_k=5
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for blaze-swap")
-        return retrieved_docs
-
-    @agent_1.tool
-    def retrieve_spark_dex_documentation(ctx: RunContext[str]):
-        """
-        Retrieves spark dex documentation.
-
-        Add "Agent tool used: retrieve-spark-dex-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="spark-dex_semantic", top_k=5
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for spark-dex")
-        return retrieved_docs
-
-    @agent_1.tool
-    def retrieve_rain_dex_documentation(ctx: RunContext[str]):
-        """
-        Retrieves rain dex documentation.
-
-        Add "Agent tool used: retrieve-rain-dex-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="rain-dex_semantic", top_k=5
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for rain-dex")
-        return retrieved_docs
-
     @agent_1.tool_plain
     async def get_validator_info_1():
         """
@@ -307,7 +345,7 @@ def setup_pydantic_consensus_agent(qdrant_client):
         url = "https://api.flaremetrics.io/v2/network/validators/flare/stakes"
 
         try:
-            response = requests.get(url)
+            response = await asyncio.to_thread(requests.get, url, timeout=VALIDATOR_API_TIMEOUT)
             response.raise_for_status()  # Raise an error for bad responses (4xx, 5xx)
 
             data = response.json()  # Convert response to JSON
@@ -339,61 +377,12 @@ def setup_pydantic_consensus_agent(qdrant_client):
             # print(all_validators)
             return all_validators
         except requests.exceptions.RequestException as e:
-            print(f"Error: {e}")
-
-    ###########################################################
-    ###################### AGENT 2 TOOLS ######################
-    ###########################################################
-
-    @agent_2.tool
-    def retrieve_flare_network_documentation_2(ctx: RunContext[str]):
-        """
-            Retrieves flare network documentation.
-
-            Add "Agent tool used: retrieve-flare-network-documentation" to the end of the message.
-            """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="flare-network", top_k=8
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for flare-network")
-        return retrieved_docs
-
-    @agent_2.tool
-    def retrieve_blaze_swap_documentation_2(ctx: RunContext[str]):
-        """
-        Retrieves blaze swap documentation.
-
-        Add "Agent tool used: retrieve-blaze-swap-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="blaze-swap", top_k=5
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for blaze-swap")
-        return retrieved_docs
+            logger.warning("Fetching validator info failed", error=str(e))
 
     ###########################################################
     ###################### AGENT 3 TOOLS ######################
     ###########################################################
 
-    @agent_3.tool
-    def retrieve_flare_network_documentation_3(ctx: RunContext[str]):
-        """
-        Retrieves flare network documentation.
-
-        Add "Agent tool used: retrieve-flare-network-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="flare-network", top_k=8
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for flare-network")
-        return retrieved_docs
-
     @agent_3.tool_plain
     async def get_validator_info():
         """
@@ -419,7 +408,7 @@ def setup_pydantic_consensus_agent(qdrant_client):
         url = "https://api.flaremetrics.io/v2/network/validators/flare/stakes"
 
         try:
-            response = requests.get(url)
+            response = await asyncio.to_thread(requests.get, url, timeout=VALIDATOR_API_TIMEOUT)
             response.raise_for_status()  # Raise an error for bad responses (4xx, 5xx)
 
             data = response.json()  # Convert response to JSON
@@ -451,40 +440,15 @@ def setup_pydantic_consensus_agent(qdrant_client):
             # print(all_validators)
             return all_validators
         except requests.exceptions.RequestException as e:
-            print(f"Error: {e}")
-
-    ###########################################################
-    ###################### AGENT 4 TOOLS ######################
-    ###########################################################
-
-    @agent_4.tool
-    def retrieve_flare_network_documentation_4(ctx: RunContext[str]):
-        """
-        Retrieves flare network documentation.
-
-        Add "Agent tool used: retrieve-flare-network-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="flare-network", top_k=8
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for flare-network")
-        return retrieved_docs
-
-    @agent_4.tool
-    def retrieve_blaze_swap_documentation_4(ctx: RunContext[str]):
-        """
-        Retrieves blaze swap documentation.
-
-        Add "Agent tool used: retrieve-blaze-swap-documentation" to the end of the message.
-        """
-        retrieved_docs = semantic_search(qdrant_client=qdrant_client,
-                                         query=ctx.deps, collection_name="blaze-swap", top_k=5
-                                         )
-
-        # print(retrieved_docs)
-        logger.info("Documents retrieved for blaze-swap")
-        return retrieved_docs
-
-    return main_agent
+            logger.warning("Fetching validator info failed", error=str(e))
+
+    # Documentation is retrieved once per request and given to every
+    # sub-agent in its prompt, so they answer from the same context
+    consensus = ConsensusAgent(
+        aggregator=main_agent,
+        sub_agents=sub_agents,
+        vector_store=vector_store,
+        collection_registry=collection_registry,
+        collection_names=list(DOCUMENTATION_COLLECTIONS.values()),
+    )
+    return consensus
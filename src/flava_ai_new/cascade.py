@@ -0,0 +1,145 @@
+"""
+Model cascade: a fast model answers first, a stronger one on low confidence
+
+The fast agent returns its answer together with a self-reported
+confidence. The answer is kept unless one of the confidence signals falls
+below its threshold, in which case the same query is run again on the
+strong agent, reusing the query embedding and searches of the first run.
+"""
+
+import os
+import re
+import statistics
+from dataclasses import dataclass, field
+
+import structlog
+from pydantic import BaseModel, Field
+from pydantic_ai import Agent
+
+from .collection_status import CollectionNotReadyError
+from .consensus import model_name
+from .retrieval import RetrievalContext
+
+logger = structlog.get_logger(__name__)
+
+# Model of the first, fast attempt
+CASCADE_FAST_MODEL = os.getenv("CASCADE_FAST_MODEL", "google-gla:gemini-2.0-flash")
+
+# The fast answer is escalated when any signal is below its threshold; a
+# threshold of 0 disables the signal.
+# Confidence the fast model reports for its own answer, from 0 to 1
+CASCADE_MIN_CONFIDENCE = float(os.getenv("CASCADE_MIN_CONFIDENCE", "0.7"))
+# Best minus median similarity of the retrieved chunks: a flat ranking means
+# no chunk clearly matches the query
+CASCADE_MIN_SCORE_SPREAD = float(os.getenv("CASCADE_MIN_SCORE_SPREAD", "0.02"))
+# Share of the answer's words that occur in the retrieved chunks
+CASCADE_MIN_CONTEXT_OVERLAP = float(os.getenv("CASCADE_MIN_CONTEXT_OVERLAP", "0.3"))
+
+# Words of four or more letters or digits, ignoring short function words
+_WORD = re.compile(r"[^\W_]{4,}")
+
+
+class CascadeAnswer(BaseModel):
+    """Structured answer of the fast agent."""
+
+    answer: str = Field(description="The answer to the user, in notion markdown format.")
+    confidence: float = Field(
+        ge=0,
+        le=1,
+        description="How confident you are, from 0 to 1, that the answer is correct and "
+        "fully supported by the retrieved documentation or tool results.",
+    )
+
+
+def score_spread(chunks: list[dict]) -> float | None:
+    """Best minus median similarity of the retrieved chunks, None for fewer than two."""
+    scores = [chunk["score"] for chunk in chunks if chunk.get("score") is not None]
+    if len(scores) < 2:
+        return None
+    return max(scores) - statistics.median(scores)
+
+
+def context_overlap(answer: str, chunks: list[dict]) -> float | None:
+    """Share of the words of `answer` found in the chunk texts, None without either."""
+    answer_words = set(_WORD.findall(answer.casefold()))
+    context_words = set()
+    for chunk in chunks:
+        context_words.update(_WORD.findall(chunk.get("text", "").casefold()))
+    if not answer_words or not context_words:
+        return None
+    return len(answer_words & context_words) / len(answer_words)
+
+
+@dataclass
+class CascadeResult:
+    """
+    Answer of a cascade run.
+
+    Attributes:
+        data (str): The final answer.
+        model (str): Name of the model that wrote it.
+        escalated (bool): Whether the strong agent was run.
+        reasons (list[str]): Signals that were below their threshold.
+        signals (dict[str, float | None]): Value of each signal for the fast
+            answer, None when it could not be measured.
+    """
+
+    data: str
+    model: str
+    escalated: bool
+    reasons: list[str] = field(default_factory=list)
+    signals: dict[str, float | None] = field(default_factory=dict)
+
+
+@dataclass
+class CascadeAgent:
+    """
+    Runs `fast`, whose result is a CascadeAnswer, and re-runs the query on
+    `strong` when the fast answer is not confident enough.
+
+    Signals that cannot be measured, such as the score spread of a run that
+    retrieved nothing, never cause an escalation. A failed fast run is
+    escalated as well.
+    """
+
+    fast: Agent
+    strong: Agent
+    min_confidence: float = CASCADE_MIN_CONFIDENCE
+    min_score_spread: float = CASCADE_MIN_SCORE_SPREAD
+    min_context_overlap: float = CASCADE_MIN_CONTEXT_OVERLAP
+
+    def check(self, answer: CascadeAnswer, deps: RetrievalContext) -> tuple[dict[str, float | None], list[str]]:
+        """Measure the confidence signals of a fast answer and list the ones below threshold."""
+        signals = {
+            "confidence": answer.confidence,
+            "score_spread": score_spread(deps.retrieved),
+            "context_overlap": context_overlap(answer.answer, deps.retrieved),
+        }
+        thresholds = {
+            "confidence": self.min_confidence,
+            "score_spread": self.min_score_spread,
+            "context_overlap": self.min_context_overlap,
+        }
+        reasons = [
+            name for name, value in signals.items()
+            if value is not None and value < thresholds[name]
+        ]
+        return signals, reasons
+
+    async def run(self, query: str, deps: RetrievalContext) -> CascadeResult:
+        try:
+            response = await self.fast.run(query, deps=deps)
+        except CollectionNotReadyError:
+            raise
+        except Exception as e:
+            logger.warning("Fast model failed, escalating", error=str(e))
+            signals, reasons = {}, ["failed"]
+        else:
+            signals, reasons = self.check(response.data, deps)
+            if not reasons:
+                logger.info("Fast model answer accepted", signals=signals)
+                return CascadeResult(response.data.answer, model_name(self.fast), False, signals=signals)
+
+        logger.info("Escalating to the strong model", reasons=reasons, signals=signals)
+        response = await self.strong.run(query, deps=deps)
+        return CascadeResult(response.data, model_name(self.strong), True, reasons, signals)
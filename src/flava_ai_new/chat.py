@@ -1,18 +1,43 @@
-from .qdrant import semantic_search
+import asyncio
+import json
+import os
+from collections.abc import AsyncIterator
+from typing import Literal
+
 import structlog
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from qdrant_client import QdrantClient
 
 from google.generativeai.generative_models import GenerativeModel
-from pydantic_ai import Agent, RunContext
+from pydantic_ai import Agent
 
+from .collection_status import CollectionNotReadyError, CollectionRegistry
+from .cascade import CascadeAgent
+from .consensus import ConsensusAgent
+from .query_router import QueryRouter, Route
+from .response import generate_response_async
+from .response_cache import RESPONSE_CACHE_BYPASS_TOOLS, response_cache
+from .retrieval import RetrievalContext
+from .vector_store import VectorStore
 
-# from .response import generate_response
 
 logger = structlog.get_logger(__name__)
 router = APIRouter()
 
+ChatMode = Literal["agent", "direct", "auto", "cascade"]
+
+# How `/` answers by default: "agent" lets the tool-calling agent decide what
+# to retrieve, "direct" retrieves up front and answers with a single LLM call,
+# "auto" answers directly when the query router's keyword rules name a
+# documentation set and no live tool, and with the agent otherwise, and
+# "cascade" runs the agent on a fast model first and only re-runs the query
+# on the agent's model when the fast answer is not confident enough
+CHAT_MODE: ChatMode = os.getenv("CHAT_MODE", "agent")  # type: ignore[assignment]
+
+# Chunks packed into the prompt in direct mode
+DIRECT_RAG_TOP_K = int(os.getenv("DIRECT_RAG_TOP_K", "8"))
+
 
 class ChatMessage(BaseModel):
     """
@@ -20,9 +45,11 @@ class ChatMessage(BaseModel):
 
     Attributes:
         message (str): The chat message content, must not be empty
+        mode (str | None): "agent", "direct", "auto" or "cascade", the router's mode if not given
     """
 
     message: str = Field(..., min_length=1)
+    mode: ChatMode | None = None
 
 
 class ChatRouter:
@@ -36,11 +63,16 @@ class ChatRouter:
     def __init__(
         self,
         router: APIRouter,
-        qdrant_client: QdrantClient,
+        vector_store: VectorStore,
         gemini_model: GenerativeModel,
         agent: Agent,
-        consensus_agent: Agent,
-        pydantic_deps
+        consensus_agent: ConsensusAgent,
+        pydantic_deps,
+        collection_registry: CollectionRegistry | None = None,
+        collection_names: list[str] | None = None,
+        mode: ChatMode = CHAT_MODE,
+        query_router: QueryRouter | None = None,
+        cascade_agent: CascadeAgent | None = None,
     ) -> None:
         """
         Initialize the ChatRouter.
@@ -50,13 +82,34 @@ class ChatRouter:
             query_router: Component that classifies the query.
             retriever: Component that retrieves relevant documents.
             responder: Component that generates a response.
+            collection_registry (CollectionRegistry): Loading state of the
+                collections, required for direct mode.
+            collection_names (list[str]): Collections searched in direct mode.
+            mode (str): Default mode of `/`, "agent", "direct", "auto" or "cascade".
+            query_router (QueryRouter): Picks the collections searched in
+                direct mode, and the mode in auto mode.
+            cascade_agent (CascadeAgent): Agent of cascade mode.
         """
+        if mode not in ("agent", "direct", "auto", "cascade"):
+            msg = f"Unknown chat mode: {mode}"
+            raise ValueError(msg)
+        if mode == "cascade" and cascade_agent is None:
+            msg = "Cascade chat mode requires a cascade agent"
+            raise ValueError(msg)
+        if mode in ("direct", "auto") and collection_registry is None:
+            msg = "Direct chat mode requires a collection registry"
+            raise ValueError(msg)
         self._router = router
-        self.qdrant_client = qdrant_client
+        self.vector_store = vector_store
         self.gemini_model = gemini_model
         self.agent = agent
         self.consensus_agent = consensus_agent
         self.pydantic_deps = pydantic_deps
+        self.collection_registry = collection_registry
+        self.collection_names = collection_names or []
+        self.mode = mode
+        self.query_router = query_router
+        self.cascade_agent = cascade_agent
         self.logger = logger.bind(router="chat")
         self._setup_routes()
 
@@ -84,28 +137,28 @@ class ChatRouter:
                 #     self.logger.info("Documents retrieved for blaze-swap")
                 #     return retrieved_docs
 
-                response = self.agent.run_sync(
-                    message.message, deps=message.message)
-
-                logger.debug(response.data)
+                deps = RetrievalContext(query=message.message)
+                mode = message.mode or self.mode
+                cached = await self._cached_response(deps, mode)
+                if cached is not None:
+                    self.logger.info("Response served from cache", mode=mode)
+                    return cached
 
-                # Generate the final answer using retrieved context.
-                # answer = generate_response(gemini_model=self.gemini_model,
-                #                            query=message.message, retrieved_documents=retrieved_docs
-                #                            )
-                # self.logger.info("Response generated", answer=answer)
-                # return {"response": answer}
-
-                self.logger.info("Response generated", answer=response.data)
-                return {"response": response.data}
+                result = {"response": await self._answer(deps, mode)}
+                await self._store_response(deps, mode, result)
+                return result
 
+            except CollectionNotReadyError as e:
+                self.logger.warning("Collection not ready", collection_name=e.collection_name)
+                raise HTTPException(status_code=503, detail=str(e),
+                                    headers={"Retry-After": "5"}) from e
             except Exception as e:
                 self.logger.exception("Chat processing failed", error=str(e))
                 raise HTTPException(status_code=500, detail=str(e)) from e
 
         @self._router.post("/consensus")
         # pyright: ignore [reportUnusedFunction]
-        async def chat_consensus(message: ChatMessage) -> dict[str, str] | None:
+        async def chat_consensus(message: ChatMessage) -> dict | None:
             """
             Process a chat message through the RAG pipeline.
             Returns a response containing the query classification and the answer.
@@ -122,8 +175,8 @@ class ChatRouter:
                 #     self.logger.info("Documents retrieved for blaze-swap")
                 #     return retrieved_docs
 
-                response = self.consensus_agent.run_sync(
-                    message.message, deps=message.message)
+                deps = RetrievalContext(query=message.message)
+                response = await self.consensus_agent.run(message.message, deps=deps)
 
                 logger.debug(response.data)
 
@@ -134,13 +187,197 @@ class ChatRouter:
                 # self.logger.info("Response generated", answer=answer)
                 # return {"response": answer}
 
-                self.logger.info("Response generated", answer=response.data)
-                return {"response": response.data}
+                self.logger.info("Response generated", answer=response.data,
+                                 aggregation=response.aggregation, agreement=response.agreement)
+                # Which sub-agents answered, timed out, failed or were
+                # cancelled, how their answers were combined and which
+                # chunks they were given
+                return {
+                    "response": response.data,
+                    "agents": response.sub_agents,
+                    "aggregation": response.aggregation,
+                    "agreement": response.agreement,
+                    "low_agreement": response.low_agreement,
+                    "context": response.context,
+                }
 
+            except CollectionNotReadyError as e:
+                self.logger.warning("Collection not ready", collection_name=e.collection_name)
+                raise HTTPException(status_code=503, detail=str(e),
+                                    headers={"Retry-After": "5"}) from e
             except Exception as e:
                 self.logger.exception("Chat processing failed", error=str(e))
                 raise HTTPException(status_code=500, detail=str(e)) from e
 
+        @self._router.post("/stream")
+        # pyright: ignore [reportUnusedFunction]
+        async def chat_stream(message: ChatMessage) -> StreamingResponse:
+            """
+            Process a chat message through the RAG pipeline, streaming the
+            answer as Server-Sent Events.
+
+            Events are `tool_call` when the agent calls a tool, `token` for
+            each piece of the answer, then `done` with the full answer, or
+            `error` if the run failed.
+            """
+            self.logger.debug("Received chat message for streaming",
+                              message=message.message)
+            return StreamingResponse(
+                self._stream_events(message.message),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+    async def _answer(self, deps: RetrievalContext, mode: ChatMode) -> str:
+        """Answer the query of `deps` in the given mode."""
+        route = None
+        if mode == "auto":
+            route = await self._route(deps)
+            # Live data is only available through the agent's tools, and
+            # keywords cannot rule a live tool out (a validator may be named
+            # without the word "validator"), so only go direct when the
+            # question clearly names the documentation it is about
+            direct = route is not None and route.keyword_collections and not route.tools
+            mode = "direct" if direct else "agent"
+
+        if mode == "direct":
+            answer = await self._answer_direct(deps, route)
+            self.logger.info("Response generated", answer=answer, mode="direct")
+            return answer
+
+        if mode == "cascade" and self.cascade_agent is not None:
+            cascade = await self.cascade_agent.run(deps.query, deps=deps)
+            self.logger.info("Response generated", answer=cascade.data, mode="cascade",
+                             model=cascade.model, escalated=cascade.escalated,
+                             reasons=cascade.reasons)
+            return cascade.data
+
+        response = await self.agent.run(deps.query, deps=deps)
+
+        logger.debug(response.data)
+
+        self.logger.info("Response generated", answer=response.data)
+        return response.data
+
+    def _needs_live_tools(self, query: str) -> bool:
+        """Whether the query router's keyword rules send the query to a tool returning live data."""
+        if self.query_router is None:
+            return False
+        route = self.query_router.route(query, None, [])
+        return any(tool in RESPONSE_CACHE_BYPASS_TOOLS for tool in route.tools)
+
+    async def _question_vector(self, deps: RetrievalContext) -> list[float] | None:
+        """
+        Embedding of the question for semantic cache lookups, or None when
+        the query carries earlier turns, whose answer may depend on them, or
+        when embedding fails.
+        """
+        if deps.has_history:
+            return None
+        try:
+            return await deps.question_vector()
+        except Exception as e:
+            self.logger.warning("Embedding the question for the response cache failed", error=str(e))
+            return None
+
+    async def _cached_response(self, deps: RetrievalContext, mode: ChatMode) -> dict | None:
+        """
+        The response cached for the same query in the same mode, or for a
+        similar enough question. Questions for live tools are never looked up.
+        """
+        if not response_cache.enabled or self._needs_live_tools(deps.question):
+            return None
+        if deps.has_history or not response_cache.semantic:
+            return response_cache.get(deps.query, scope=mode)
+        # Only embed the question when there is no exact match
+        cached = response_cache.get_exact(deps.query, scope=mode)
+        if cached is not None:
+            return cached
+        return response_cache.get(deps.query, await self._question_vector(deps), scope=mode)
+
+    async def _store_response(self, deps: RetrievalContext, mode: ChatMode, result: dict) -> None:
+        """
+        Cache a response unless it is for, or used, a live tool or was
+        answered while collections were still loading.
+        """
+        if not response_cache.enabled or self._needs_live_tools(deps.question):
+            return
+        if any(tool in RESPONSE_CACHE_BYPASS_TOOLS for tool in deps.tool_calls):
+            return
+        if self.collection_registry is not None and not all(
+            self.collection_registry.is_ready(name) for name in self.collection_names
+        ):
+            return
+        query_vector = await self._question_vector(deps)
+        if query_vector is None and not deps.has_history:
+            return
+        response_cache.put(deps.query, result, query_vector, scope=mode)
+
+    async def _route(self, deps: RetrievalContext) -> Route | None:
+        """Route the query among the ready collections, if there is a query router."""
+        if self.query_router is None or self.collection_registry is None:
+            return None
+        collection_names = self.collection_registry.ready_collections(self.collection_names)
+        return self.query_router.route(deps.question, await deps.question_vector(), collection_names)
+
+    async def _answer_direct(self, deps: RetrievalContext, route: Route | None = None) -> str:
+        """
+        Answer without the agent: search the collections the query router
+        picks (every ready collection without a router) with one federated
+        search and generate the answer from the results with a single model
+        call.
+        """
+        if self.collection_registry is None:
+            msg = "Direct chat mode requires a collection registry"
+            raise RuntimeError(msg)
+        if route is None:
+            route = await self._route(deps)
+        if route is not None:
+            collection_names = route.collections
+        else:
+            collection_names = self.collection_registry.ready_collections(self.collection_names)
+        retrieved_docs = await deps.federated_search(
+            self.vector_store, collection_names, DIRECT_RAG_TOP_K)
+        self.logger.info("Documents retrieved", collection_names=collection_names,
+                         num_documents=len(retrieved_docs), mode="direct")
+        return await generate_response_async(
+            gemini_model=self.gemini_model, query=deps.query, retrieved_documents=retrieved_docs)
+
+    async def _stream_events(self, query: str) -> AsyncIterator[str]:
+        """
+        Run the agent with `run_stream` and yield its tool calls and answer
+        tokens as SSE messages as soon as they are available.
+        """
+        events: asyncio.Queue = asyncio.Queue()
+        deps = RetrievalContext(query=query, events=events)
+
+        async def run() -> None:
+            try:
+                answer = ""
+                async with self.agent.run_stream(query, deps=deps) as result:
+                    async for delta in result.stream_text(delta=True, debounce_by=None):
+                        answer += delta
+                        events.put_nowait(("token", {"text": delta}))
+                self.logger.info("Response generated", answer=answer)
+                events.put_nowait(("done", {"response": answer}))
+            except CollectionNotReadyError as e:
+                self.logger.warning("Collection not ready", collection_name=e.collection_name)
+                events.put_nowait(("error", {"status": 503, "detail": str(e)}))
+            except Exception as e:
+                self.logger.exception("Chat processing failed", error=str(e))
+                events.put_nowait(("error", {"status": 500, "detail": str(e)}))
+            finally:
+                events.put_nowait(None)
+
+        task = asyncio.create_task(run())
+        try:
+            while (item := await events.get()) is not None:
+                event, data = item
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            # The client went away before the run finished
+            task.cancel()
+
     @property
     def router(self) -> APIRouter:
         """Return the underlying FastAPI router with registered endpoints."""
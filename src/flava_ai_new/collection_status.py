@@ -0,0 +1,90 @@
+"""
+Tracks the loading state of the vector store collections
+"""
+
+import threading
+from enum import Enum
+
+
+class CollectionStatus(str, Enum):
+    """Loading state of a single collection."""
+
+    PENDING = "pending"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+
+class CollectionNotReadyError(Exception):
+    """Raised when a collection is queried before it finished loading."""
+
+    def __init__(self, collection_name: str, status: CollectionStatus) -> None:
+        super().__init__(
+            f"Collection '{collection_name}' is not ready yet (status: {status.value})"
+        )
+        self.collection_name = collection_name
+        self.status = status
+
+
+class CollectionRegistry:
+    """
+    Thread-safe registry of collection loading states.
+
+    Collections are loaded in the background after the app starts serving;
+    the registry lets request handlers and health checks see which ones can
+    already be queried.
+    """
+
+    def __init__(self, collection_names: list[str]) -> None:
+        self._lock = threading.Lock()
+        self._status = {name: CollectionStatus.PENDING for name in collection_names}
+        self._errors: dict[str, str] = {}
+
+    def set_status(
+        self, collection_name: str, status: CollectionStatus, error: str | None = None
+    ) -> None:
+        """Update the state of a collection, recording the error if it failed."""
+        with self._lock:
+            self._status[collection_name] = status
+            if error is None:
+                self._errors.pop(collection_name, None)
+            else:
+                self._errors[collection_name] = error
+
+    def status(self, collection_name: str) -> CollectionStatus:
+        with self._lock:
+            return self._status.get(collection_name, CollectionStatus.PENDING)
+
+    def is_ready(self, collection_name: str) -> bool:
+        return self.status(collection_name) == CollectionStatus.READY
+
+    def require_ready(self, collection_name: str) -> None:
+        """
+        Raise CollectionNotReadyError unless the collection can be queried.
+        """
+        status = self.status(collection_name)
+        if status != CollectionStatus.READY:
+            raise CollectionNotReadyError(collection_name, status)
+
+    def ready_collections(self, collection_names: list[str]) -> list[str]:
+        """
+        The collections among `collection_names` that can be queried.
+
+        Raises CollectionNotReadyError for the first one if none of them can.
+        """
+        ready = [name for name in collection_names if self.is_ready(name)]
+        if collection_names and not ready:
+            self.require_ready(collection_names[0])
+        return ready
+
+    def report(self) -> dict[str, dict]:
+        """Per-collection status, with the error of failed collections."""
+        with self._lock:
+            return {
+                name: (
+                    {"status": status.value, "error": self._errors[name]}
+                    if name in self._errors
+                    else {"status": status.value}
+                )
+                for name, status in self._status.items()
+            }
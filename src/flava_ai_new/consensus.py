@@ -0,0 +1,364 @@
+"""
+Consensus over the answers of several sub-agents
+
+The documentation is retrieved once per request and the same context is
+given to every sub-agent, which then run concurrently. Their answers are either aggregated
+locally, by picking the answer the others agree with most, or handed to an
+LLM aggregator agent when they disagree.
+"""
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import structlog
+from pydantic_ai import Agent
+
+from .collection_status import CollectionRegistry
+from .embedding import embed_texts_async
+from .retrieval import RetrievalContext
+from .vector_store import VectorStore
+
+logger = structlog.get_logger(__name__)
+
+# Seconds a consensus sub-agent may take before its answer is given up on;
+# CONSENSUS_TIMEOUT_<N> overrides it for sub-agent N
+CONSENSUS_AGENT_TIMEOUT = float(os.getenv("CONSENSUS_AGENT_TIMEOUT", "60"))
+
+# Quorum mode: the main agent proceeds once CONSENSUS_QUORUM sub-agents have
+# answered, or once CONSENSUS_LATENCY_BUDGET seconds have passed, and the
+# remaining sub-agents are cancelled. 0 disables either limit.
+CONSENSUS_QUORUM = int(os.getenv("CONSENSUS_QUORUM", "0"))
+CONSENSUS_LATENCY_BUDGET = float(os.getenv("CONSENSUS_LATENCY_BUDGET", "0"))
+
+# Chunks retrieved once per request and shared by all sub-agents
+CONSENSUS_CONTEXT_TOP_K = int(os.getenv("CONSENSUS_CONTEXT_TOP_K", "8"))
+
+# Local aggregation embeds the sub-agent answers and returns the medoid
+# answer without calling the aggregator LLM, as long as at least
+# CONSENSUS_AGREEMENT_THRESHOLD of the answers have a cosine similarity of
+# CONSENSUS_SIMILARITY_THRESHOLD or more with it
+CONSENSUS_LOCAL_AGGREGATION = os.getenv("CONSENSUS_LOCAL_AGGREGATION", "false").lower() == "true"
+CONSENSUS_SIMILARITY_THRESHOLD = float(os.getenv("CONSENSUS_SIMILARITY_THRESHOLD", "0.9"))
+CONSENSUS_AGREEMENT_THRESHOLD = float(os.getenv("CONSENSUS_AGREEMENT_THRESHOLD", "0.75"))
+
+
+@dataclass
+class SubAgent:
+    """A consensus sub-agent and how long it may take to answer."""
+
+    name: str
+    agent: Agent
+    timeout: float
+
+
+@dataclass
+class SubAgentResult:
+    """
+    Outcome of one sub-agent run: "ok", "timeout", "failed", or "cancelled"
+    when quorum mode stopped waiting for it.
+    """
+
+    name: str
+    model: str
+    status: str
+    latency: float
+    response: str | None = None
+    error: Exception | None = None
+
+    def summary(self) -> dict:
+        """JSON-serialisable report of the run, without the answer."""
+        return {
+            "agent": self.name,
+            "model": self.model,
+            "status": self.status,
+            "latency": round(self.latency, 3),
+        }
+
+
+def model_name(agent: Agent) -> str:
+    """Name of the model an agent runs on."""
+    return str(getattr(agent.model, "model_name", agent.model))
+
+
+async def run_sub_agent(
+    sub_agent: SubAgent, deps: RetrievalContext, prompt: str | None = None
+) -> SubAgentResult:
+    """
+    Run a sub-agent within its timeout, turning a timeout or failure into a
+    result instead of an exception. The sub-agent is prompted with `prompt`,
+    or with the bare query.
+    """
+    model = model_name(sub_agent.agent)
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(
+            sub_agent.agent.run(prompt or deps.query, deps=deps), timeout=sub_agent.timeout)
+    except asyncio.TimeoutError as e:
+        status, response, error = "timeout", None, e
+    except Exception as e:
+        status, response, error = "failed", None, e
+    else:
+        status, response, error = "ok", result.data, None
+
+    latency = time.perf_counter() - start
+    if error is None:
+        logger.info("Sub-agent answered", agent=sub_agent.name, model=model, latency=latency)
+    else:
+        logger.warning("Sub-agent did not answer", agent=sub_agent.name, model=model,
+                       status=status, latency=latency, error=str(error))
+    return SubAgentResult(sub_agent.name, model, status, latency, response, error)
+
+
+async def run_sub_agents(
+    sub_agents: list[SubAgent],
+    deps: RetrievalContext,
+    quorum: int = 0,
+    latency_budget: float = 0,
+    prompt: str | None = None,
+) -> list[SubAgentResult]:
+    """
+    Run the sub-agents concurrently, each within its own timeout.
+
+    With a `quorum`, stop waiting once that many sub-agents have answered;
+    with a `latency_budget`, stop waiting after that many seconds. The
+    sub-agents still running then are cancelled and reported as
+    "cancelled". Failed and timed-out sub-agents are reported as well.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + latency_budget if latency_budget > 0 else None
+    tasks = {
+        asyncio.ensure_future(run_sub_agent(sub_agent, deps, prompt)): sub_agent
+        for sub_agent in sub_agents
+    }
+    finished: dict[str, SubAgentResult] = {}
+    pending = set(tasks)
+    try:
+        while pending:
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info("Consensus latency budget expired", budget=latency_budget)
+                break
+            for task in done:
+                finished[tasks[task].name] = task.result()
+            num_answers = sum(result.status == "ok" for result in finished.values())
+            if quorum > 0 and num_answers >= quorum and pending:
+                logger.info("Consensus quorum reached", quorum=quorum)
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    results = [
+        finished.get(sub_agent.name)
+        or SubAgentResult(sub_agent.name, model_name(sub_agent.agent), "cancelled",
+                          loop.time() - start)
+        for sub_agent in sub_agents
+    ]
+    return results
+
+
+def build_context_prompt(query: str, chunks: list[dict]) -> str:
+    """Prompt a sub-agent with the retrieved chunks followed by the query."""
+    if not chunks:
+        return query
+    sections = []
+    for number, chunk in enumerate(chunks, start=1):
+        metadata = chunk.get("metadata") or {}
+        sections.append(
+            f"[{number}] {metadata.get('page_title', '')} ({metadata.get('page_url', '')})\n"
+            f"{chunk['text']}"
+        )
+    return "Context:\n\n" + "\n\n".join(sections) + f"\n\nQuestion: {query}"
+
+
+def _chunk_reference(chunk: dict) -> dict:
+    metadata = chunk.get("metadata") or {}
+    return {
+        "collection": chunk.get("collection"),
+        "page_url": metadata.get("page_url"),
+        "page_title": metadata.get("page_title"),
+        "chunk_number": metadata.get("chunk_number"),
+        "score": chunk.get("score"),
+    }
+
+
+def format_sub_agent_results(results: list[SubAgentResult]) -> str:
+    """Render the sub-agent answers, and which ones are missing, for the main agent."""
+    sections = []
+    for result in results:
+        if result.status == "ok":
+            sections.append(f"{result.name} response:\n\n{result.response}\n\n")
+        elif result.status in ("timeout", "cancelled"):
+            sections.append(f"{result.name} did not respond in time.\n\n")
+        else:
+            sections.append(f"{result.name} failed to respond.\n\n")
+    return "\n".join(sections)
+
+
+@dataclass
+class Agreement:
+    """
+    How far the sub-agent answers agree.
+
+    Attributes:
+        medoid (int): Index of the answer most similar to all others.
+        agreeing (list[int]): Indices of the answers close to the medoid,
+            including the medoid itself.
+        agreement (float): Share of the answers that are close to the medoid.
+        similarities (np.ndarray): Pairwise cosine similarities.
+    """
+
+    medoid: int
+    agreeing: list[int]
+    agreement: float
+    similarities: np.ndarray
+
+
+def measure_agreement(embeddings: list[list[float]], similarity_threshold: float) -> Agreement:
+    """
+    Find the medoid of the answer embeddings and the cluster of answers
+    within `similarity_threshold` cosine similarity of it.
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms == 0, 1, norms)
+    similarities = vectors @ vectors.T
+
+    if len(vectors) == 1:
+        return Agreement(0, [0], 1.0, similarities)
+
+    # Mean similarity to the other answers, leaving out the diagonal
+    support = (similarities.sum(axis=1) - np.diag(similarities)) / (len(vectors) - 1)
+    medoid = int(np.argmax(support))
+    agreeing = [int(i) for i in np.flatnonzero(similarities[medoid] >= similarity_threshold)]
+    if medoid not in agreeing:
+        agreeing.append(medoid)
+    return Agreement(medoid, sorted(agreeing), len(agreeing) / len(vectors), similarities)
+
+
+@dataclass
+class ConsensusResult:
+    """
+    Answer of a consensus run.
+
+    Attributes:
+        data (str): The final answer.
+        sub_agents (list[dict]): Status of each sub-agent.
+        aggregation (str): "local" when the medoid answer was returned,
+            "llm" when the aggregator agent wrote the answer.
+        agreement (float | None): Share of the answers agreeing with the
+            medoid, when it was measured.
+        low_agreement (bool): Whether the answers disagreed.
+        context (list[dict]): The chunks given to the sub-agents.
+    """
+
+    data: str
+    sub_agents: list[dict]
+    aggregation: str
+    agreement: float | None = None
+    low_agreement: bool = False
+    context: list[dict] = field(default_factory=list)
+
+
+@dataclass
+class ConsensusAgent:
+    """
+    Runs the sub-agents, then aggregates their answers.
+
+    With a `vector_store`, the query is searched once across
+    `collection_names` and the sub-agents are prompted with the retrieved
+    chunks, instead of each running its own retrieval tool calls.
+
+    With `local_aggregation`, the answers are embedded and the medoid answer
+    is returned directly when enough of them agree with it; the aggregator
+    agent, which reads every answer through its `get_multiple_responses`
+    tool, is only run when they disagree or cannot be compared.
+    """
+
+    aggregator: Agent
+    sub_agents: list[SubAgent]
+    vector_store: VectorStore | None = None
+    collection_registry: CollectionRegistry | None = None
+    collection_names: list[str] = field(default_factory=list)
+    context_top_k: int = CONSENSUS_CONTEXT_TOP_K
+    quorum: int = CONSENSUS_QUORUM
+    latency_budget: float = CONSENSUS_LATENCY_BUDGET
+    local_aggregation: bool = CONSENSUS_LOCAL_AGGREGATION
+    similarity_threshold: float = CONSENSUS_SIMILARITY_THRESHOLD
+    agreement_threshold: float = CONSENSUS_AGREEMENT_THRESHOLD
+
+    @property
+    def agents(self) -> list[Agent]:
+        """Every agent involved, aggregator first."""
+        return [self.aggregator, *(sub_agent.agent for sub_agent in self.sub_agents)]
+
+    async def collect(self, deps: RetrievalContext) -> list[SubAgentResult]:
+        """
+        Run the sub-agents once per run; the aggregator's tool calls reuse
+        the results.
+        """
+        results = await deps.memoized(("consensus_sub_agents", id(self)), lambda: self._collect(deps))
+        deps.sub_agents = [result.summary() for result in results]
+        return results
+
+    async def _collect(self, deps: RetrievalContext) -> list[SubAgentResult]:
+        prompt = None
+        if self.vector_store is not None and self.collection_names:
+            collection_names = self.collection_names
+            if self.collection_registry is not None:
+                collection_names = self.collection_registry.ready_collections(collection_names)
+            chunks = await deps.federated_search(self.vector_store, collection_names, self.context_top_k)
+            deps.context_chunks = [_chunk_reference(chunk) for chunk in chunks]
+            logger.info("Shared context retrieved for the sub-agents", num_chunks=len(chunks))
+            prompt = build_context_prompt(deps.query, chunks)
+
+        return await run_sub_agents(
+            self.sub_agents,
+            deps,
+            quorum=self.quorum,
+            latency_budget=self.latency_budget,
+            prompt=prompt,
+        )
+
+    async def run(self, query: str, deps: RetrievalContext) -> ConsensusResult:
+        if not self.local_aggregation:
+            response = await self.aggregator.run(query, deps=deps)
+            return ConsensusResult(response.data, deps.sub_agents, "llm", context=deps.context_chunks)
+
+        results = await self.collect(deps)
+        answers = [result for result in results if result.status == "ok"]
+
+        agreement = None
+        if len(answers) >= 2:
+            try:
+                embeddings = await embed_texts_async([result.response for result in answers])
+                agreement = measure_agreement(embeddings, self.similarity_threshold)
+            except Exception as e:
+                logger.warning("Embedding the sub-agent answers failed", error=str(e))
+
+        if agreement is not None and agreement.agreement >= self.agreement_threshold:
+            medoid = answers[agreement.medoid]
+            logger.info("Consensus reached locally", agent=medoid.name,
+                        agreement=agreement.agreement)
+            return ConsensusResult(medoid.response, deps.sub_agents, "local", agreement.agreement,
+                                   context=deps.context_chunks)
+
+        logger.info("Low agreement between sub-agents, running the aggregator",
+                    agreement=None if agreement is None else agreement.agreement)
+        response = await self.aggregator.run(query, deps=deps)
+        return ConsensusResult(
+            response.data,
+            deps.sub_agents,
+            "llm",
+            None if agreement is None else agreement.agreement,
+            low_agreement=True,
+            context=deps.context_chunks,
+        )
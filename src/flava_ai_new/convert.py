@@ -0,0 +1,75 @@
+"""
+Convert embedding JSON files into binary snapshots
+"""
+
+import argparse
+from pathlib import Path
+
+import structlog
+
+from .corpus import load_embedding_json, save_snapshot, snapshot_dir
+
+logger = structlog.get_logger(__name__)
+
+DEFAULT_DATA_DIR = "src/data"
+DEFAULT_PATTERNS = ("*_simple_d*.json", "*_semantic_d*.json")
+
+
+def convert(file_path: Path, dtype: str = "float16", output_dir: Path | None = None) -> dict:
+    """
+    Convert a single embedding JSON file into a snapshot.
+
+    :param file_path: The JSON file to convert.
+    :param dtype: Storage dtype of the vectors.
+    :param output_dir: Directory to write the snapshot to. Defaults to the
+        directory `load_corpus` looks for next to the JSON file.
+    :return: The written manifest.
+    """
+    corpus = load_embedding_json(file_path)
+    directory = output_dir / file_path.stem if output_dir else snapshot_dir(file_path)
+    return save_snapshot(corpus, directory, dtype=dtype, source_file=file_path)
+
+
+def main() -> None:
+    """
+    Entry point of the convert-embeddings command.
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert embedding JSON files into memory-mappable snapshots."
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        type=Path,
+        help=f"JSON files to convert. Defaults to {' and '.join(DEFAULT_PATTERNS)} in {DEFAULT_DATA_DIR}.",
+    )
+    parser.add_argument(
+        "--dtype", choices=["float16", "float32"], default="float16",
+        help="Storage dtype of the vectors.",
+    )
+    parser.add_argument(
+        "--output-dir", type=Path, default=None,
+        help="Write snapshots here instead of next to each JSON file.",
+    )
+    args = parser.parse_args()
+
+    files = args.files or sorted(
+        path
+        for pattern in DEFAULT_PATTERNS
+        for path in Path(DEFAULT_DATA_DIR).glob(pattern)
+    )
+    if not files:
+        parser.error("No embedding JSON files found.")
+
+    for file_path in files:
+        manifest = convert(file_path, dtype=args.dtype, output_dir=args.output_dir)
+        logger.info(
+            "Converted embedding file.",
+            file_path=str(file_path),
+            num_chunks=manifest["num_chunks"],
+            dtype=manifest["dtype"],
+        )
+
+
+if __name__ == "__main__":
+    main()
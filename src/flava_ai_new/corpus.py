@@ -0,0 +1,455 @@
+"""
+Columnar loading of embedding dataset files
+
+A dataset is either an embedding JSON file or a binary snapshot converted
+from it. A snapshot is a directory next to the JSON file, named after it
+without the extension, containing:
+
+    vectors.npy    (n, dim) float16 matrix, memory-mapped on load
+    payload.jsonl  one record per chunk, in the same order as the vectors
+    manifest.json  format version, shape, dtype and fingerprints
+
+The centroid of a dataset, used to route queries, is kept next to it in
+<name>.centroid.json together with the fingerprint it was computed from.
+"""
+
+import functools
+import hashlib
+import json
+import re
+import uuid
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TextIO
+
+import numpy as np
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+EMBEDDING_VECTOR_SIZE = 768
+
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_VECTORS_FILE = "vectors.npy"
+SNAPSHOT_PAYLOAD_FILE = "payload.jsonl"
+SNAPSHOT_MANIFEST_FILE = "manifest.json"
+CENTROID_FILE_SUFFIX = ".centroid.json"
+
+# Whitespace and commas between the items of a JSON array
+_JSON_SEPARATORS = re.compile(r"[\s,]*")
+
+
+@dataclass
+class EmbeddingCorpus:
+    """
+    A set of embedded document chunks held column by column.
+
+    Attributes:
+        embeddings (np.ndarray): Contiguous matrix of shape (n, dim); float32
+            when loaded from JSON, a read-only float16 memmap when loaded from
+            a snapshot.
+        page_url (list[str]): Source page of each chunk.
+        page_title (list[str]): Title of the source page.
+        page_description (list[str]): Description of the source page.
+        chunk_number (np.ndarray): Position of each chunk within its page.
+        text (list[str]): The chunk contents.
+    """
+
+    embeddings: np.ndarray
+    page_url: list[str]
+    page_title: list[str]
+    page_description: list[str]
+    chunk_number: np.ndarray
+    text: list[str]
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def payload(self, position: int) -> dict:
+        """Build the Qdrant payload for the chunk at `position`."""
+        return {
+            "page_url": self.page_url[position],
+            "page_title": self.page_title[position],
+            "page_description": self.page_description[position],
+            "chunk_number": int(self.chunk_number[position]),
+            "text": self.text[position],
+        }
+
+
+PAYLOAD_FIELDS = ("page_url", "page_title", "page_description", "chunk_number", "chunk")
+
+
+def file_fingerprint(file_path: str | Path, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute a SHA-256 fingerprint of a source file without loading it whole.
+
+    :param file_path: Path of the file to fingerprint.
+    :param chunk_size: Number of bytes read per iteration.
+    :return: The hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with Path(file_path).open("rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_hash(payload: dict, vector: np.ndarray) -> str:
+    """
+    Hash everything that ends up in a stored point, so that a changed chunk,
+    title, description or embedding yields a different point.
+    """
+    digest = hashlib.sha256()
+    for field in ("page_url", "chunk_number", "page_title", "page_description", "text"):
+        digest.update(str(payload.get(field)).encode())
+        digest.update(b"\0")
+    digest.update(np.asarray(vector, dtype="<f4").tobytes())
+    return digest.hexdigest()
+
+
+def point_id(page_url: str, chunk_number: int, chunk_hash: str) -> str:
+    """
+    Deterministic point ID for a chunk.
+
+    The ID only depends on the chunk itself, not on its position in the source
+    file, so re-ingesting a file maps unchanged chunks onto the same points.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{page_url}#{chunk_number}#{chunk_hash}"))
+
+
+def snapshot_dir(file_path: str | Path) -> Path:
+    """Directory holding the binary snapshot of an embedding JSON file."""
+    file_path = Path(file_path)
+    return file_path.with_name(file_path.stem)
+
+
+def read_snapshot_manifest(directory: str | Path) -> dict | None:
+    """Read a snapshot manifest, or return None if there is no usable snapshot."""
+    manifest_path = Path(directory) / SNAPSHOT_MANIFEST_FILE
+    if not manifest_path.is_file():
+        return None
+    with manifest_path.open() as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        logger.warning(
+            "Ignoring snapshot with unsupported format version.",
+            directory=str(directory),
+            format_version=manifest.get("format_version"),
+        )
+        return None
+    return manifest
+
+
+@functools.lru_cache(maxsize=64)
+def _source_matches(file_path: Path, mtime_ns: int, size: int, source_fingerprint: str | None) -> bool:
+    # Keyed by modification time and size so that a file is hashed once per change
+    return source_fingerprint is not None and file_fingerprint(file_path) == source_fingerprint
+
+
+def _snapshot_manifest_for(file_path: str | Path) -> dict | None:
+    """
+    Manifest of the snapshot of `file_path`, or None if there is none or it
+    is stale. A JSON file modified after its snapshot was written is hashed
+    and compared with the manifest's `source_fingerprint`, so that touching
+    the file keeps the snapshot while changing it falls back to the JSON.
+    """
+    file_path = Path(file_path)
+    directory = snapshot_dir(file_path)
+    manifest = read_snapshot_manifest(directory)
+    if manifest is None or not file_path.is_file():
+        return manifest
+    stat = file_path.stat()
+    if stat.st_mtime <= (directory / SNAPSHOT_MANIFEST_FILE).stat().st_mtime:
+        return manifest
+    if _source_matches(file_path, stat.st_mtime_ns, stat.st_size, manifest.get("source_fingerprint")):
+        return manifest
+    logger.warning(
+        "Snapshot is older than its changed source file, loading the JSON file instead; "
+        "re-run convert-embeddings.",
+        file_path=str(file_path),
+    )
+    return None
+
+
+def has_snapshot(file_path: str | Path) -> bool:
+    """Whether `load_corpus` would load a binary snapshot for `file_path`."""
+    return _snapshot_manifest_for(file_path) is not None
+
+
+def corpus_fingerprint(file_path: str | Path) -> str:
+    """
+    Fingerprint of the dataset that `load_corpus` would load for `file_path`.
+
+    Uses the fingerprint recorded in the snapshot manifest when a snapshot
+    exists, so that checking for changes does not read the dataset itself.
+    """
+    manifest = _snapshot_manifest_for(file_path)
+    if manifest is not None:
+        return manifest["fingerprint"]
+    return file_fingerprint(file_path)
+
+
+def corpus_centroid(corpus: EmbeddingCorpus, block_size: int = 8192) -> np.ndarray:
+    """
+    Mean of the L2-normalised embeddings of a corpus, read in blocks so that
+    a memory-mapped snapshot is never converted whole.
+
+    :param corpus: The corpus to summarise.
+    :param block_size: Number of rows converted to float32 at a time.
+    :return: The centroid as a float32 vector.
+    """
+    total = np.zeros(corpus.embeddings.shape[1], dtype=np.float64)
+    for start in range(0, len(corpus), block_size):
+        block = np.asarray(corpus.embeddings[start:start + block_size], dtype=np.float32)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        total += (block / np.where(norms == 0, 1, norms)).sum(axis=0)
+    return (total / max(len(corpus), 1)).astype(np.float32)
+
+
+def centroid_path(file_path: str | Path) -> Path:
+    """File holding the centroid of the dataset for an embedding JSON file."""
+    file_path = Path(file_path)
+    return file_path.with_name(file_path.stem + CENTROID_FILE_SUFFIX)
+
+
+def save_centroid(file_path: str | Path, fingerprint: str, centroid: np.ndarray) -> None:
+    """
+    Store the centroid of a dataset. Failing to write it is only logged,
+    since the centroid can always be recomputed.
+
+    :param file_path: Path of the embedding JSON file.
+    :param fingerprint: Fingerprint of the dataset the centroid was computed from.
+    :param centroid: The centroid vector.
+    """
+    try:
+        with centroid_path(file_path).open("w") as f:
+            json.dump({"fingerprint": fingerprint, "centroid": np.asarray(centroid).tolist()}, f)
+    except OSError as e:
+        logger.warning("Saving the centroid failed", file_path=str(file_path), error=str(e))
+
+
+def load_centroid(file_path: str | Path, fingerprint: str) -> np.ndarray | None:
+    """
+    Read the stored centroid of a dataset.
+
+    :param file_path: Path of the embedding JSON file.
+    :param fingerprint: Current fingerprint of the dataset.
+    :return: The centroid, or None if none is stored for this fingerprint.
+    """
+    path = centroid_path(file_path)
+    if not path.is_file():
+        return None
+    with path.open() as f:
+        stored = json.load(f)
+    if stored.get("fingerprint") != fingerprint:
+        return None
+    return np.asarray(stored["centroid"], dtype=np.float32)
+
+
+def load_corpus(
+    file_path: str | Path, vector_size: int = EMBEDDING_VECTOR_SIZE
+) -> EmbeddingCorpus:
+    """
+    Load the dataset for an embedding JSON file, preferring its binary
+    snapshot and falling back to parsing the JSON file.
+    """
+    if _snapshot_manifest_for(file_path) is not None:
+        return load_snapshot(snapshot_dir(file_path), vector_size)
+    return load_embedding_json(file_path, vector_size)
+
+
+def save_snapshot(
+    corpus: EmbeddingCorpus,
+    directory: str | Path,
+    dtype: str = "float16",
+    source_file: str | Path | None = None,
+) -> dict:
+    """
+    Write a corpus as a binary snapshot.
+
+    :param corpus: The corpus to write.
+    :param directory: Snapshot directory, created if missing.
+    :param dtype: Storage dtype of the vectors, float16 or float32.
+    :param source_file: JSON file the corpus was loaded from, if any.
+    :return: The written manifest.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    vectors = np.ascontiguousarray(corpus.embeddings, dtype=dtype)
+    np.save(directory / SNAPSHOT_VECTORS_FILE, vectors, allow_pickle=False)
+
+    with (directory / SNAPSHOT_PAYLOAD_FILE).open("w") as f:
+        for position in range(len(corpus)):
+            payload = corpus.payload(position)
+            payload["chunk"] = payload.pop("text")
+            f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+
+    digest = hashlib.sha256()
+    digest.update(file_fingerprint(directory / SNAPSHOT_VECTORS_FILE).encode())
+    digest.update(file_fingerprint(directory / SNAPSHOT_PAYLOAD_FILE).encode())
+
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "num_chunks": len(corpus),
+        "vector_size": int(vectors.shape[1]),
+        "dtype": str(vectors.dtype),
+        "fingerprint": digest.hexdigest(),
+        "source_file": Path(source_file).name if source_file else None,
+        "source_fingerprint": file_fingerprint(source_file) if source_file else None,
+    }
+    # Written last so that an interrupted conversion leaves no usable snapshot
+    with (directory / SNAPSHOT_MANIFEST_FILE).open("w") as f:
+        json.dump(manifest, f, indent=4)
+
+    logger.info("Snapshot has been saved.", directory=str(directory), num_chunks=len(corpus))
+    return manifest
+
+
+def load_snapshot(
+    directory: str | Path, vector_size: int = EMBEDDING_VECTOR_SIZE
+) -> EmbeddingCorpus:
+    """
+    Load a binary snapshot. The vector block is memory-mapped rather than
+    read, so it is shared with the page cache and costs no parse time.
+
+    :param directory: Snapshot directory.
+    :param vector_size: Expected dimension of the embeddings.
+    :return: The loaded corpus.
+    """
+    directory = Path(directory)
+    manifest = read_snapshot_manifest(directory)
+    if manifest is None:
+        msg = f"No snapshot found in {directory}"
+        raise FileNotFoundError(msg)
+
+    vectors = np.load(directory / SNAPSHOT_VECTORS_FILE, mmap_mode="r")
+    if vectors.ndim != 2 or vectors.shape != (manifest["num_chunks"], vector_size):
+        msg = f"Snapshot vectors in {directory} have shape {vectors.shape}, expected ({manifest['num_chunks']}, {vector_size})"
+        raise ValueError(msg)
+
+    columns: dict[str, list] = {field: [] for field in PAYLOAD_FIELDS}
+    with (directory / SNAPSHOT_PAYLOAD_FILE).open() as f:
+        for line in f:
+            record = json.loads(line)
+            for field in PAYLOAD_FIELDS:
+                columns[field].append(record.get(field))
+
+    if len(columns["chunk"]) != len(vectors):
+        msg = f"Snapshot payload in {directory} does not match its vectors"
+        raise ValueError(msg)
+
+    return EmbeddingCorpus(
+        embeddings=vectors,
+        page_url=columns["page_url"],
+        page_title=columns["page_title"],
+        page_description=columns["page_description"],
+        chunk_number=np.asarray(columns["chunk_number"], dtype=np.int64),
+        text=columns["chunk"],
+    )
+
+
+def _iter_json_array(f: TextIO, chunk_size: int = 1 << 20) -> Iterator:
+    """
+    Yield the items of a top-level JSON array one at a time, reading the file
+    in chunks so that only the item being decoded is held as Python objects.
+
+    :param f: Text file containing a JSON array.
+    :param chunk_size: Number of characters read at a time.
+    :return: An iterator over the decoded items.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    while True:
+        position = _JSON_SEPARATORS.match(buffer, position).end()
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != "[":
+                    msg = "Expected a JSON array"
+                    raise ValueError(msg)
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The item may continue in the next chunk
+                if eof:
+                    raise
+            else:
+                yield item
+                continue
+        elif eof:
+            msg = "Unexpected end of JSON array"
+            raise ValueError(msg)
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def load_embedding_json(
+    file_path: str | Path, vector_size: int = EMBEDDING_VECTOR_SIZE
+) -> EmbeddingCorpus:
+    """
+    Load an embedding JSON file into an EmbeddingCorpus.
+
+    Records are decoded one at a time and their embeddings converted to
+    float32 rows straight away, so peak memory is about twice the float32
+    matrix plus the chunk texts, rather than the whole file as Python lists.
+    Snapshots written by convert-embeddings avoid even that by being
+    memory-mapped.
+
+    Records with missing text or an embedding of the wrong dimension are
+    dropped with a warning.
+
+    :param file_path: Path of the JSON file, a list of chunk records.
+    :param vector_size: Expected dimension of the embeddings.
+    :return: The loaded corpus.
+    """
+    page_url, page_title, page_description, chunk_number, text, rows = (
+        [], [], [], [], [], []
+    )
+    num_records = 0
+    num_invalid_dim = 0
+    with Path(file_path).open() as f:
+        for record in _iter_json_array(f):
+            num_records += 1
+            embedding = record.get("embedding")
+            if not isinstance(record.get("chunk"), str):
+                continue
+            if not isinstance(embedding, list) or len(embedding) != vector_size:
+                num_invalid_dim += 1
+                continue
+            page_url.append(record.get("page_url"))
+            page_title.append(record.get("page_title"))
+            page_description.append(record.get("page_description"))
+            chunk_number.append(record.get("chunk_number") or 0)
+            text.append(record["chunk"])
+            rows.append(np.asarray(embedding, dtype=np.float32))
+
+    if len(rows) < num_records:
+        logger.warning(
+            "Skipping documents due to missing content or invalid embedding.",
+            file_path=str(file_path),
+            num_skipped=num_records - len(rows),
+            num_invalid_dim=num_invalid_dim,
+        )
+
+    matrix = np.stack(rows) if rows else np.empty((0, vector_size), dtype=np.float32)
+    del rows
+
+    return EmbeddingCorpus(
+        embeddings=matrix,
+        page_url=page_url,
+        page_title=page_title,
+        page_description=page_description,
+        chunk_number=np.asarray(chunk_number, dtype=np.int64),
+        text=text,
+    )
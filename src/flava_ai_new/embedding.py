@@ -1,11 +1,128 @@
 
 
+import asyncio
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import structlog
 from google.generativeai.embedding import (
     EmbeddingTaskType,
 )
 from google.generativeai.embedding import (
     embed_content as _embed_content,
 )
+from google.generativeai.embedding import (
+    embed_content_async as _embed_content_async,
+)
+
+from .embedding_batcher import EmbeddingBatcher
+from .embedding_cache import EmbeddingCache, PersistentEmbeddingCache, normalize_query
+
+logger = structlog.get_logger(__name__)
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Query embeddings kept in memory; a size of 0 disables the cache and a TTL
+# of 0 keeps entries until they are evicted
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+
+# SQLite file holding query embeddings across restarts, shared by every
+# worker on the host; an empty path disables it
+EMBEDDING_STORE_PATH = os.getenv(
+    "EMBEDDING_STORE_PATH",
+    str(Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "flava_ai_new" / "embedding_cache.sqlite3"),
+)
+EMBEDDING_STORE_MAX_ENTRIES = int(os.getenv("EMBEDDING_STORE_MAX_ENTRIES", "50000"))
+
+# Query log, one query per line, embedded into the store at startup
+EMBEDDING_WARMUP_FILE = os.getenv("EMBEDDING_WARMUP_FILE", "")
+
+# Concurrent query embeddings are coalesced into one batch request: a batch
+# is sent this many milliseconds after its first query, or once it is full
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "100"))
+
+# Texts per embedding request when pre-warming
+_WARMUP_BATCH_SIZE = 100
+
+query_embedding_cache = EmbeddingCache(max_size=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL)
+_persistent_embedding_cache: PersistentEmbeddingCache | None = None
+_persistent_embedding_cache_opened = False
+_persistent_embedding_cache_lock = threading.Lock()
+
+
+def get_persistent_embedding_cache() -> PersistentEmbeddingCache | None:
+    """
+    Open the persistent embedding store on first use. Opening creates the
+    database and prunes it, so callers on the event loop should run this in
+    a worker thread; the server opens it at startup.
+
+    Returns:
+        PersistentEmbeddingCache | None: The store, or None when it is
+            disabled or could not be opened, in which case only the
+            in-memory cache is used.
+    """
+    global _persistent_embedding_cache, _persistent_embedding_cache_opened
+    if _persistent_embedding_cache_opened:
+        return _persistent_embedding_cache
+    with _persistent_embedding_cache_lock:
+        if not _persistent_embedding_cache_opened:
+            if EMBEDDING_STORE_PATH:
+                try:
+                    _persistent_embedding_cache = PersistentEmbeddingCache(
+                        EMBEDDING_STORE_PATH, max_entries=EMBEDDING_STORE_MAX_ENTRIES)
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning("Opening the embedding store failed, it is disabled",
+                                   path=EMBEDDING_STORE_PATH, error=str(e))
+            _persistent_embedding_cache_opened = True
+    return _persistent_embedding_cache
+
+
+async def _embed_batch(texts: list[str]) -> list[list[float]]:
+    response = await _embed_content_async(
+        model=EMBEDDING_MODEL, content=texts, task_type=EmbeddingTaskType.RETRIEVAL_QUERY
+    )
+    return response["embedding"]
+
+
+query_embedding_batcher = EmbeddingBatcher(
+    _embed_batch,
+    window=EMBEDDING_BATCH_WINDOW_MS / 1000,
+    max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+)
+
+
+def _stored_embedding(contents: str) -> list[float] | None:
+    """Look the query up in the persistent store, copying a hit into memory."""
+    persistent_embedding_cache = get_persistent_embedding_cache()
+    if persistent_embedding_cache is None:
+        return None
+    embedding = persistent_embedding_cache.get(EMBEDDING_MODEL, contents)
+    if embedding is not None:
+        query_embedding_cache.put(EMBEDDING_MODEL, contents, embedding)
+    return embedding
+
+
+def _store_embedding(contents: str, embedding: list[float]) -> None:
+    persistent_embedding_cache = get_persistent_embedding_cache()
+    if persistent_embedding_cache is not None:
+        persistent_embedding_cache.put(EMBEDDING_MODEL, contents, embedding)
+
+
+def _cached_embedding(contents: str) -> list[float] | None:
+    """Look the query up in memory, then in the persistent store."""
+    embedding = query_embedding_cache.get(EMBEDDING_MODEL, contents)
+    if embedding is not None:
+        return embedding
+    return _stored_embedding(contents)
+
+
+def _cache_embedding(contents: str, embedding: list[float]) -> None:
+    query_embedding_cache.put(EMBEDDING_MODEL, contents, embedding)
+    _store_embedding(contents, embedding)
 
 
 def embed_content(
@@ -14,19 +131,124 @@ def embed_content(
     """
     Generate text embeddings using Gemini.
 
+    Embeddings are cached by the normalised query text, in memory and in the
+    persistent store, so repeated and near-identical queries skip the remote
+    call. Called from a worker thread while the server's event loop runs,
+    cache misses are coalesced into batch requests.
+
     Args:
-        model (str): The embedding model to use (e.g., "text-embedding-004").
         contents (str): The text to be embedded.
 
     Returns:
         list[float]: The generated embedding vector.
     """
-    response = _embed_content(
-        model="models/text-embedding-004", content=contents, task_type=EmbeddingTaskType.RETRIEVAL_QUERY
-    )
-    try:
-        embedding = response["embedding"]
-    except (KeyError, IndexError) as e:
-        msg = "Failed to extract embedding from response."
-        raise ValueError(msg) from e
+    embedding = _cached_embedding(contents)
+    if embedding is not None:
+        return embedding
+
+    if query_embedding_batcher.can_embed_threadsafe():
+        # Join the next batch on the server loop instead of sending a
+        # request of our own
+        embedding = query_embedding_batcher.embed_threadsafe(contents)
+    else:
+        response = _embed_content(
+            model=EMBEDDING_MODEL, content=contents, task_type=EmbeddingTaskType.RETRIEVAL_QUERY
+        )
+        try:
+            embedding = response["embedding"]
+        except (KeyError, IndexError) as e:
+            msg = "Failed to extract embedding from response."
+            raise ValueError(msg) from e
+
+    _cache_embedding(contents, embedding)
+    return embedding
+
+
+async def embed_content_async(contents: str) -> list[float]:
+    """
+    Generate text embeddings using Gemini without blocking the event loop.
+
+    Cache misses are coalesced with concurrent queries into batch requests.
+    The persistent store is read and written in a worker thread, since a
+    locked SQLite database can block for seconds.
+
+    Args:
+        contents (str): The text to be embedded.
+
+    Returns:
+        list[float]: The generated embedding vector.
+    """
+    embedding = query_embedding_cache.get(EMBEDDING_MODEL, contents)
+    if embedding is not None:
+        return embedding
+    embedding = await asyncio.to_thread(_stored_embedding, contents)
+    if embedding is not None:
+        return embedding
+
+    embedding = await query_embedding_batcher.embed(contents)
+    query_embedding_cache.put(EMBEDDING_MODEL, contents, embedding)
+    await asyncio.to_thread(_store_embedding, contents, embedding)
     return embedding
+
+
+async def embed_texts_async(
+    texts: list[str], task_type: EmbeddingTaskType = EmbeddingTaskType.SEMANTIC_SIMILARITY
+) -> list[list[float]]:
+    """
+    Embed several texts with one batch request, bypassing the query caches.
+
+    Args:
+        texts (list[str]): The texts to be embedded.
+        task_type (EmbeddingTaskType): What the embeddings are used for.
+
+    Returns:
+        list[list[float]]: One embedding vector per text.
+    """
+    if not texts:
+        return []
+    response = await _embed_content_async(model=EMBEDDING_MODEL, content=texts, task_type=task_type)
+    return response["embedding"]
+
+
+def warm_embedding_cache(query_log: str | Path = EMBEDDING_WARMUP_FILE) -> int:
+    """
+    Embed the queries of a query log that the persistent store does not hold
+    yet, in batched requests.
+
+    Args:
+        query_log (str | Path): Text file with one query per line.
+
+    Returns:
+        int: The number of queries embedded.
+    """
+    if not query_log:
+        return 0
+    persistent_embedding_cache = get_persistent_embedding_cache()
+    if persistent_embedding_cache is None:
+        return 0
+
+    queries: dict[str, str] = {}
+    with Path(query_log).open() as f:
+        for line in f:
+            query = line.strip()
+            if query:
+                queries.setdefault(normalize_query(query), query)
+    missing = [
+        query for query in queries.values()
+        if not persistent_embedding_cache.contains(EMBEDDING_MODEL, query)
+    ]
+
+    for start in range(0, len(missing), _WARMUP_BATCH_SIZE):
+        batch = missing[start:start + _WARMUP_BATCH_SIZE]
+        response = _embed_content(
+            model=EMBEDDING_MODEL, content=batch, task_type=EmbeddingTaskType.RETRIEVAL_QUERY
+        )
+        persistent_embedding_cache.put_many(
+            EMBEDDING_MODEL, list(zip(batch, response["embedding"])))
+
+    logger.info(
+        "The embedding cache has been warmed.",
+        num_queries=len(queries),
+        num_embedded=len(missing),
+    )
+    return len(missing)
@@ -0,0 +1,122 @@
+"""
+Coalesces concurrent embedding requests into batch calls
+"""
+
+import asyncio
+from collections.abc import Awaitable, Callable
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    Collects the texts requested within a short window and embeds them with
+    a single batch call, then hands each caller its own vector.
+
+    The first request of a batch opens a window of `window` seconds; the
+    batch is sent when the window closes or once `max_batch_size` texts are
+    waiting, whichever comes first. Identical texts within a batch are
+    embedded once. A failed batch call fails every request of the batch.
+
+    The batcher belongs to the event loop it is first used on (or bound to
+    with `bind`); threads outside that loop submit through `embed_threadsafe`.
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[list[str]], Awaitable[list[list[float]]]],
+        window: float = 0.005,
+        max_batch_size: int = 100,
+    ) -> None:
+        """
+        Args:
+            embed_batch: Coroutine function embedding a list of texts, returning
+                the vectors in the same order.
+            window (float): Seconds to wait for more requests after the first one.
+            max_batch_size (int): Texts per batch call.
+        """
+        self._embed_batch = embed_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Attach the batcher to the event loop that sends its batches."""
+        self.loop = loop
+
+    async def embed(self, text: str) -> list[float]:
+        """Embed `text` as part of the next batch."""
+        loop = asyncio.get_running_loop()
+        if self.loop is None or self.loop.is_closed():
+            self.loop = loop
+
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self.num_requests += 1
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def embed_threadsafe(self, text: str, timeout: float | None = None) -> list[float]:
+        """
+        Embed `text` from a thread other than the batcher's event loop,
+        blocking until the batch it joined has been embedded.
+        """
+        if self.loop is None or not self.loop.is_running():
+            msg = "The embedding batcher is not bound to a running event loop"
+            raise RuntimeError(msg)
+        return asyncio.run_coroutine_threadsafe(self.embed(text), self.loop).result(timeout)
+
+    def can_embed_threadsafe(self) -> bool:
+        """Whether `embed_threadsafe` can be used from the calling thread."""
+        if self.loop is None or not self.loop.is_running():
+            return False
+        try:
+            return asyncio.get_running_loop() is not self.loop
+        except RuntimeError:
+            return True
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.num_batches += 1
+        try:
+            vectors = await self._embed_batch(texts)
+        except Exception as e:
+            logger.warning("Embedding batch failed", batch_size=len(texts), error=str(e))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logger.debug("Embedding batch sent", batch_size=len(texts), num_requests=len(batch))
+        vectors_by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors_by_text[text])
+
+    def stats(self) -> dict[str, int | float]:
+        """Requests received, batch calls sent and the mean batch size."""
+        return {
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "mean_batch_size": self.num_requests / self.num_batches if self.num_batches else 0.0,
+        }
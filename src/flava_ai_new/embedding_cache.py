@@ -0,0 +1,252 @@
+"""
+Caches of query embeddings
+
+EmbeddingCache is a per-process LRU cache. PersistentEmbeddingCache is a
+SQLite file that survives restarts and is shared by all workers on the host.
+"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalise a query so that trivially different spellings share a cache
+    entry: unicode compatibility forms are folded (NFKC), case is folded and
+    runs of whitespace collapse to a single space.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE.sub(" ", text.casefold()).strip()
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of embedding vectors keyed by model and normalised
+    text.
+
+    Entries expire `ttl` seconds after they were stored; a `ttl` of 0 keeps
+    them until they are evicted. Once `max_size` entries are held, storing a
+    new one evicts the least recently used entry.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple[str, str], tuple[float, tuple[float, ...]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, model: str, text: str) -> list[float] | None:
+        """Return the cached vector for `text`, or None on a miss."""
+        key = (model, normalize_query(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl > 0 and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, model: str, text: str, vector: list[float]) -> None:
+        """Store the vector for `text`, evicting the least recently used entries."""
+        if self.max_size <= 0:
+            return
+        key = (model, normalize_query(text))
+        with self._lock:
+            self._entries[key] = (time.monotonic(), tuple(vector))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int | float]:
+        """Entry count, hit/miss counters and the hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class PersistentEmbeddingCache:
+    """
+    Embedding vectors stored in a SQLite database, keyed by a hash of the
+    model and the normalised text, with the vectors as float32 blobs.
+
+    The database runs in WAL mode, so any number of processes can read it
+    while one of them writes. Each thread uses its own connection. When more
+    than `max_entries` vectors are stored the oldest ones are deleted.
+
+    Storage errors are logged and treated as misses: the cache never fails
+    an embedding request.
+    """
+
+    # Stores between two checks of the entry count
+    _PRUNE_INTERVAL = 256
+
+    def __init__(self, path: str | Path, max_entries: int = 50_000) -> None:
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stores_since_prune = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+        self._prune()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_query(text)}".encode()).hexdigest()
+
+    def get(self, model: str, text: str) -> list[float] | None:
+        """Return the stored vector for `text`, or None on a miss."""
+        try:
+            row = self._connection().execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (self._key(model, text),)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Reading the embedding cache failed", error=str(e))
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return np.frombuffer(row[0], dtype="<f4").tolist()
+
+    def contains(self, model: str, text: str) -> bool:
+        try:
+            row = self._connection().execute(
+                "SELECT 1 FROM embeddings WHERE key = ?", (self._key(model, text),)
+            ).fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None
+
+    def put(self, model: str, text: str, vector: list[float]) -> None:
+        """Store the vector for `text`, replacing any previous one."""
+        self.put_many(model, [(text, vector)])
+
+    def put_many(self, model: str, items: list[tuple[str, list[float]]]) -> None:
+        """Store several vectors in one transaction."""
+        if self.max_entries <= 0 or not items:
+            return
+        now = time.time()
+        rows = [
+            (self._key(model, text), model, np.asarray(vector, dtype="<f4").tobytes(), now)
+            for text, vector in items
+        ]
+        try:
+            with self._connection() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector, created_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error as e:
+            logger.warning("Writing the embedding cache failed", error=str(e))
+            return
+
+        with self._lock:
+            self._stores_since_prune += len(rows)
+            prune = self._stores_since_prune >= self._PRUNE_INTERVAL
+            if prune:
+                self._stores_since_prune = 0
+        if prune:
+            self._prune()
+
+    def _prune(self) -> None:
+        """Delete the oldest entries beyond `max_entries`."""
+        try:
+            with self._connection() as connection:
+                (count,) = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+                excess = count - self.max_entries
+                if excess > 0:
+                    connection.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY created_at LIMIT ?)",
+                        (excess,),
+                    )
+                    logger.info("Pruned the embedding cache.", num_deleted=excess)
+        except sqlite3.Error as e:
+            logger.warning("Pruning the embedding cache failed", error=str(e))
+
+    def __len__(self) -> int:
+        try:
+            (count,) = self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Counting the embedding cache failed", error=str(e))
+            return 0
+        return count
+
+    def stats(self) -> dict[str, int | float | str]:
+        """Entry count and hit/miss counters of this process."""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "path": str(self.path),
+            "size": len(self),
+            "max_size": self.max_entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
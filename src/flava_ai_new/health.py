@@ -0,0 +1,78 @@
+"""
+Liveness and readiness endpoints
+"""
+
+import asyncio
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from .collection_status import CollectionRegistry, CollectionStatus
+from .embedding import get_persistent_embedding_cache, query_embedding_batcher, query_embedding_cache
+from .response_cache import response_cache
+
+
+class HealthRouter:
+    """
+    Health check endpoints.
+
+    `/live` only reports that the process is serving requests. `/ready`
+    reports the loading state of every collection and returns 503 until all
+    of them are ready. `/cache` reports the hit and miss counters of the
+    in-process caches.
+    """
+
+    def __init__(self, router: APIRouter, collection_registry: CollectionRegistry) -> None:
+        """
+        Initialize the HealthRouter.
+
+        Args:
+            router (APIRouter): FastAPI router to attach endpoints.
+            collection_registry (CollectionRegistry): Loading state of the collections.
+        """
+        self._router = router
+        self.collection_registry = collection_registry
+        self._setup_routes()
+
+    def _setup_routes(self) -> None:
+        """
+        Set up FastAPI routes for the health endpoints.
+        """
+
+        @self._router.get("/live")
+        # pyright: ignore [reportUnusedFunction]
+        async def live() -> dict[str, str]:
+            return {"status": "ok"}
+
+        @self._router.get("/ready")
+        # pyright: ignore [reportUnusedFunction]
+        async def ready() -> JSONResponse:
+            collections = self.collection_registry.report()
+            statuses = {collection["status"] for collection in collections.values()}
+            if statuses <= {CollectionStatus.READY.value}:
+                status = "ready"
+            elif statuses & {CollectionStatus.PENDING.value, CollectionStatus.LOADING.value}:
+                status = "loading"
+            else:
+                status = "failed"
+            return JSONResponse(
+                status_code=200 if status == "ready" else 503,
+                content={"status": status, "collections": collections},
+            )
+
+        @self._router.get("/cache")
+        # pyright: ignore [reportUnusedFunction]
+        async def cache() -> dict[str, dict]:
+            caches = {"embedding": query_embedding_cache.stats()}
+            # Counting the store's rows is SQLite work, kept off the event loop
+            persistent_embedding_cache = await asyncio.to_thread(get_persistent_embedding_cache)
+            if persistent_embedding_cache is not None:
+                caches["embedding_store"] = await asyncio.to_thread(persistent_embedding_cache.stats)
+            caches["embedding_batches"] = query_embedding_batcher.stats()
+            caches["response"] = response_cache.stats()
+            return caches
+
+    @property
+    def router(self) -> APIRouter:
+        """Return the underlying FastAPI router with registered endpoints."""
+        return self._router
@@ -1,20 +1,44 @@
+import asyncio
+import multiprocessing
+import random
+import threading
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
 from dotenv import load_dotenv
-import pandas as pd
 import structlog
 import uvicorn
 from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
 import os
 # from dataclasses import dataclass
 
-
-import nest_asyncio
-
 from .chat import ChatRouter
-from .agents import setup_pydantic_agent, setup_pydantic_consensus_agent
-
-from .qdrant import generate_collection
+from .collection_status import CollectionRegistry, CollectionStatus
+from .health import HealthRouter
+from .agents import (
+    DOCUMENTATION_COLLECTIONS,
+    ROUTING_RULES,
+    setup_pydantic_agent,
+    setup_pydantic_cascade_agent,
+    setup_pydantic_consensus_agent,
+)
+
+from .embedding import get_persistent_embedding_cache, query_embedding_batcher, warm_embedding_cache
+from .corpus import (
+    EmbeddingCorpus,
+    corpus_centroid,
+    corpus_fingerprint,
+    has_snapshot,
+    load_centroid,
+    load_corpus,
+    save_centroid,
+)
+from .qdrant import QdrantVectorStore
+from .query_router import QueryRouter
+from .vector_store import EmbeddedVectorStore, VectorStore
 from google.generativeai.generative_models import GenerativeModel
 
 from .PROMPTS import SYSTEM_INSTRUCTION
@@ -28,6 +52,26 @@ configure(api_key=os.getenv("GEMINI_API_KEY"))
 
 logger = structlog.get_logger(__name__)
 
+# How long the background loader waits for the vector store to come up
+QDRANT_STARTUP_TIMEOUT = float(os.getenv("QDRANT_STARTUP_TIMEOUT", "120"))
+
+# A collection that fails to load with a transient error, such as Qdrant
+# being unreachable, or a vector store that is not up within
+# QDRANT_STARTUP_TIMEOUT, is retried after a delay doubling from
+# COLLECTION_RETRY_DELAY up to COLLECTION_RETRY_MAX_DELAY seconds; with
+# COLLECTION_MAX_ATTEMPTS of 0 it is retried until shutdown
+COLLECTION_RETRY_DELAY = float(os.getenv("COLLECTION_RETRY_DELAY", "5"))
+COLLECTION_RETRY_MAX_DELAY = float(os.getenv("COLLECTION_RETRY_MAX_DELAY", "300"))
+COLLECTION_MAX_ATTEMPTS = int(os.getenv("COLLECTION_MAX_ATTEMPTS", "0"))
+
+# "qdrant" to use the Qdrant server, "embedded" to search in process
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "qdrant")
+# Build an approximate HNSW index for the embedded backend (needs hnswlib)
+VECTOR_STORE_HNSW = os.getenv("VECTOR_STORE_HNSW", "false").lower() == "true"
+
+# Number of collections loaded concurrently at startup
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+
 
 # @dataclass
 # class PydanticAIDeps:
@@ -46,6 +90,9 @@ logger = structlog.get_logger(__name__)
 #         "qdrant_collection_name": "flare-network_semantic"},
 #     {"file_name": "blaze-swap_simple_d3.json", "qdrant_collection_name": "blaze-swap"}, {"file_name": "spark-dex_semantic_d3.json", "qdrant_collection_name": "spark-dex_semantic"}, {"file_name": "rain-dex_semantic_d3.json", "qdrant_collection_name": "rain-dex_semantic"}]
 
+# Each entry may set "quantization" to "scalar" (int8, 4x smaller), "binary"
+# (1 bit, 32x smaller) or "product" to compress the vectors held in RAM;
+# search then rescores the best candidates with the original vectors.
 EMBEDDING_SAVE_FILES = [
     {"file_name": "flare-network_simple_d2.json",
         "qdrant_collection_name": "flare-network"},
@@ -66,35 +113,202 @@ EMBEDDING_SAVE_FILES = [
 
 
 def setup_qdrant():
-    # Load RAG data and convert to df
-    df_docs = []
-
-    logger.debug("Loading JSON dataset files")
-    for file in EMBEDDING_SAVE_FILES:
-        df_read = pd.read_json(f"src/data/{file['file_name']}")
-        df_docs.append(
-            {"df": df_read, "qdrant_collection_name": file["qdrant_collection_name"]})
-
-    logger.info("Loaded JSON Data.", num_dfs=len(df_docs))
-
     # Setup qdrant client
     qdrant_client = QdrantClient(
         host="localhost", port=6333)
 
-    # Generate qdrant collection
-    for file in df_docs:
-        generate_collection(
-            file["df"],
-            qdrant_client,
-            file["qdrant_collection_name"]
-        )
+    return qdrant_client
+
+
+def setup_async_qdrant():
+    # Async client for searches from the event loop
+    return AsyncQdrantClient(host="localhost", port=6333)
+
+
+def setup_vector_store() -> VectorStore:
+    """
+    Create the vector store selected by VECTOR_STORE_BACKEND: "qdrant" for
+    the Qdrant server, "embedded" for the in-process NumPy engine.
+    """
+    if VECTOR_STORE_BACKEND == "embedded":
+        return EmbeddedVectorStore(hnsw=VECTOR_STORE_HNSW)
+    if VECTOR_STORE_BACKEND == "qdrant":
+        return QdrantVectorStore(setup_qdrant(), setup_async_qdrant())
+    msg = f"Unknown VECTOR_STORE_BACKEND: {VECTOR_STORE_BACKEND}"
+    raise ValueError(msg)
+
+
+def _register_centroid(
+    query_router: QueryRouter,
+    collection_name: str,
+    file_path: str,
+    fingerprint: str,
+    corpus: EmbeddingCorpus | None = None,
+) -> None:
+    """
+    Hand the centroid of a dataset to the query router, reading the stored
+    one when it matches the fingerprint and computing it otherwise.
+    """
+    centroid = load_centroid(file_path, fingerprint)
+    if centroid is None:
+        if corpus is None:
+            corpus = load_corpus(file_path)
+        centroid = corpus_centroid(corpus)
+        save_centroid(file_path, fingerprint, centroid)
+    query_router.set_centroid(collection_name, centroid)
+
+
+def load_collection(
+    vector_store: VectorStore,
+    file: dict,
+    parse_pool: Executor | None = None,
+    query_router: QueryRouter | None = None,
+) -> None:
+    """
+    Load a dataset file into its vector store collection, from its binary
+    snapshot where one exists, skipping files whose collection is already
+    loaded with the same fingerprint.
+
+    JSON files are parsed in `parse_pool` when given, since parsing is CPU
+    bound; snapshots are memory-mapped in the calling thread. The centroid
+    of the dataset is registered with `query_router` when given.
+    """
+    file_path = f"src/data/{file['file_name']}"
+    fingerprint = corpus_fingerprint(file_path)
+
+    quantization = file.get("quantization")
+
+    if vector_store.is_current(file["qdrant_collection_name"], fingerprint, quantization):
+        logger.info("Reusing persisted collection.",
+                    collection_name=file["qdrant_collection_name"])
+        if query_router is not None:
+            _register_centroid(query_router, file["qdrant_collection_name"], file_path, fingerprint)
+        return
+
+    if parse_pool is not None and not has_snapshot(file_path):
+        corpus = parse_pool.submit(load_corpus, file_path).result()
+    else:
+        corpus = load_corpus(file_path)
+    vector_store.add_corpus(
+        file["qdrant_collection_name"], corpus, fingerprint=fingerprint, quantization=quantization)
+    if query_router is not None:
+        _register_centroid(query_router, file["qdrant_collection_name"], file_path, fingerprint, corpus)
+
+
+def _wait_before_retry(attempt: int, stop: threading.Event) -> bool:
+    """
+    Sleep before retrying after failed attempt number `attempt`, counted from
+    1. Returns False, without sleeping the full delay, when no more attempts
+    are allowed or `stop` is set.
+    """
+    if COLLECTION_MAX_ATTEMPTS and attempt >= COLLECTION_MAX_ATTEMPTS:
+        return False
+    delay = min(COLLECTION_RETRY_DELAY * 2 ** (attempt - 1), COLLECTION_RETRY_MAX_DELAY)
+    # Jittered so that collections failing together do not retry in lockstep
+    delay *= random.uniform(0.5, 1)
+    logger.info("Retrying after a delay.", attempt=attempt, delay=round(delay, 1))
+    return not stop.wait(delay)
+
+
+def _is_transient(error: Exception) -> bool:
+    """
+    Whether loading a collection may succeed when retried: the vector store
+    was unreachable, timed out or overloaded, or the parse pool crashed.
+    Missing or corrupt data files and rejected requests are permanent.
+    """
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code is None or error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (ConnectionError, TimeoutError, ResponseHandlingException, BrokenExecutor))
+
+
+def _load_and_track(
+    vector_store: VectorStore,
+    file: dict,
+    collection_registry: CollectionRegistry,
+    parse_pool: Executor | None,
+    query_router: QueryRouter | None = None,
+    stop: threading.Event | None = None,
+) -> None:
+    collection_name = file["qdrant_collection_name"]
+    stop = stop or threading.Event()
+    attempt = 0
+    while True:
+        attempt += 1
+        collection_registry.set_status(collection_name, CollectionStatus.LOADING)
+        try:
+            load_collection(vector_store, file, parse_pool, query_router)
+        except Exception as e:
+            collection_registry.set_status(
+                collection_name, CollectionStatus.FAILED, error=str(e))
+            if not _is_transient(e):
+                logger.exception("Loading collection failed, not retrying",
+                                 collection_name=collection_name, error=str(e))
+                return
+            logger.exception("Loading collection failed",
+                             collection_name=collection_name, attempt=attempt, error=str(e))
+            if isinstance(e, BrokenExecutor):
+                # A crashed parse worker breaks the pool for good
+                parse_pool = None
+            if not _wait_before_retry(attempt, stop):
+                return
+            continue
+        collection_registry.set_status(collection_name, CollectionStatus.READY)
+        return
+
+
+def load_collections(
+    vector_store: VectorStore,
+    collection_registry: CollectionRegistry,
+    workers: int = INGEST_WORKERS,
+    query_router: QueryRouter | None = None,
+    stop: threading.Event | None = None,
+) -> None:
+    """
+    Load every file in EMBEDDING_SAVE_FILES, recording the progress of each
+    collection in the registry. A failing collection does not stop the
+    others. Transient failures are retried with backoff until the
+    collection loads or `stop` is set; permanent ones leave it FAILED.
+
+    Up to `workers` collections are loaded concurrently, with JSON files
+    parsed in a process pool of the same size, so startup is bounded by the
+    largest collection rather than the sum of all of them.
+    """
+    stop = stop or threading.Event()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            vector_store.wait_until_available(QDRANT_STARTUP_TIMEOUT)
+            break
+        except Exception as e:
+            logger.exception("Vector store did not become available", attempt=attempt, error=str(e))
+            for file in EMBEDDING_SAVE_FILES:
+                collection_registry.set_status(
+                    file["qdrant_collection_name"], CollectionStatus.FAILED, error=str(e))
+            if not _wait_before_retry(attempt, stop):
+                return
+
+    # Spawn rather than fork: the server process already runs threads
+    with (
+        ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as parse_pool,
+        ThreadPoolExecutor(max_workers=workers) as upload_pool,
+    ):
+        for file in EMBEDDING_SAVE_FILES:
+            upload_pool.submit(_load_and_track, vector_store, file,
+                               collection_registry, parse_pool, query_router, stop)
 
     logger.info(
-        "The Qdrant collection has been generated.",
-        # collection_name=retriever_config.collection_name,  # noqa: ERA001
+        "The collections have been loaded.",
+        collections=collection_registry.report(),
     )
 
-    return qdrant_client
+
+def warm_embedding_cache_safely() -> None:
+    """Pre-warm the embedding store, logging instead of raising on failure."""
+    try:
+        warm_embedding_cache()
+    except Exception as e:
+        logger.exception("Warming the embedding cache failed", error=str(e))
 
 
 def setup_gemini():
@@ -108,10 +322,32 @@ def setup_gemini():
 
 def create_app() -> FastAPI:
 
-    nest_asyncio.apply()
+    vector_store = setup_vector_store()
+    collection_registry = CollectionRegistry(
+        [file["qdrant_collection_name"] for file in EMBEDDING_SAVE_FILES])
+    # Collection centroids are registered as the collections load
+    query_router = QueryRouter(ROUTING_RULES)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Embedding requests from tool threads are batched on the server loop
+        query_embedding_batcher.bind(asyncio.get_running_loop())
+        # Open the embedding store before serving, off the event loop
+        await asyncio.to_thread(get_persistent_embedding_cache)
+        # Serve immediately and load the collections in the background;
+        # /health/ready reports when they are available
+        stop_loading = threading.Event()
+        app.state.collection_loader = asyncio.create_task(
+            asyncio.to_thread(load_collections, vector_store, collection_registry,
+                              query_router=query_router, stop=stop_loading))
+        app.state.embedding_warmup = asyncio.create_task(
+            asyncio.to_thread(warm_embedding_cache_safely))
+        yield
+        # Stop retrying collections so that shutdown does not wait on them
+        stop_loading.set()
 
     app = FastAPI(title="Flare Knowledge API",
-                  version="1.0", redirect_slashes=False)
+                  version="1.0", redirect_slashes=False, lifespan=lifespan)
 
     # Optional: configure CORS middleware using settings.
     app.add_middleware(
@@ -122,41 +358,51 @@ def create_app() -> FastAPI:
         allow_headers=["*"],
     )
 
-    qdrant_client = setup_qdrant()
-
     gemini_model = setup_gemini()
 
     # Setup Pydantic AI Agent
 
-    agent = setup_pydantic_agent(qdrant_client)
-    consensus_agent = setup_pydantic_consensus_agent(qdrant_client)
+    agent = setup_pydantic_agent(vector_store, collection_registry, query_router)
+    cascade_agent = setup_pydantic_cascade_agent(
+        vector_store, collection_registry, agent, query_router)
+    consensus_agent = setup_pydantic_consensus_agent(
+        vector_store, collection_registry)
 
     # Create an APIRouter for chat endpoints and initialize ChatRouter.
     chat_router = ChatRouter(
         router=APIRouter(),
-        qdrant_client=qdrant_client,
+        vector_store=vector_store,
         gemini_model=gemini_model,
         agent=agent,
         # pydantic_deps=PydanticAIDeps
         consensus_agent=consensus_agent,
-        pydantic_deps=None
+        pydantic_deps=None,
+        collection_registry=collection_registry,
+        collection_names=list(DOCUMENTATION_COLLECTIONS.values()),
+        query_router=query_router,
+        cascade_agent=cascade_agent,
     )
     app.include_router(chat_router.router,
                        prefix="/api/routes/chat", tags=["chat"])
+    app.state.chat_router = chat_router
     # app.include_router(chat_router.router,
     #                    prefix="/api/routes/chat/consensus", tags=["consensus"])
 
-    return app
-
+    health_router = HealthRouter(
+        router=APIRouter(), collection_registry=collection_registry)
+    app.include_router(health_router.router, prefix="/health", tags=["health"])
 
-app = create_app()
+    return app
 
 
 def start() -> None:
     """
     Start the FastAPI application server.
+
+    The app is built here rather than at import time, since the spawned
+    parse workers re-import the module that started the server.
     """
-    uvicorn.run(app, host="0.0.0.0", port=8080)  # noqa: S104
+    uvicorn.run(create_app(), host="0.0.0.0", port=8080)  # noqa: S104
 
 
 if __name__ == "__main__":
@@ -1,126 +1,665 @@
+import asyncio
+import os
+import time
+import uuid
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import islice
 
-import pandas as pd
+import numpy as np
 import structlog
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, PointStruct, VectorParams
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    Batch,
+    CompressionRatio,
+    Distance,
+    PointIdsList,
+    PointStruct,
+    ProductQuantization,
+    ProductQuantizationConfig,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    ScoredPoint,
+    SearchParams,
+    VectorParams,
+)
 
 from google.generativeai.embedding import (
     EmbeddingTaskType,
 )
 
-from .embedding import embed_content
+from .corpus import EMBEDDING_VECTOR_SIZE, EmbeddingCorpus, content_hash, point_id
+from .embedding import embed_content, embed_content_async
+from .vector_store import QUANTIZATION_OVERSAMPLING, VectorStore, check_quantization
 
 logger = structlog.get_logger(__name__)
 
+# Number of points per upsert request and number of requests kept in flight
+# while uploading a collection.
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+INGEST_PARALLEL_BATCHES = int(os.getenv("INGEST_PARALLEL_BATCHES", "4"))
+
+# Weight of a hit's margin over its own collection's baseline in the merged
+# federated ranking; the rest of the weight goes to its raw similarity
+FEDERATED_MARGIN_WEIGHT = float(os.getenv("FEDERATED_MARGIN_WEIGHT", "0.25"))
+
+# Holds one point per ingested collection recording the fingerprint of the
+# source file and the vector config it was built with.
+INGEST_MANIFEST_COLLECTION = "flava_ingest_manifest"
+
+
+def _collection_config(vector_size: int, quantization: str | None = None) -> dict:
+    """Vector config a collection is built with, as stored in the manifest."""
+    return {
+        "vector_size": vector_size,
+        "distance": Distance.COSINE.value,
+        "quantization": quantization,
+    }
+
+
+def _quantization_config(
+    quantization: str | None,
+) -> ScalarQuantization | BinaryQuantization | ProductQuantization | None:
+    """
+    Qdrant quantization config for a quantization type. Quantized vectors
+    are kept in RAM while the originals, only read for rescoring, stay on disk.
+    """
+    if quantization == "scalar":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+        )
+    if quantization == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    if quantization == "product":
+        return ProductQuantization(
+            product=ProductQuantizationConfig(compression=CompressionRatio.X16, always_ram=True)
+        )
+    return None
+
+
+def _quantization_type(
+    config: ScalarQuantization | BinaryQuantization | ProductQuantization | None,
+) -> str | None:
+    if isinstance(config, ScalarQuantization):
+        return "scalar"
+    if isinstance(config, BinaryQuantization):
+        return "binary"
+    if isinstance(config, ProductQuantization):
+        return "product"
+    return None
+
+
+def _manifest_point_id(collection_name: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"flava-ingest/{collection_name}"))
+
+
+def _ensure_manifest_collection(client: QdrantClient) -> None:
+    if not client.collection_exists(INGEST_MANIFEST_COLLECTION):
+        client.create_collection(
+            collection_name=INGEST_MANIFEST_COLLECTION,
+            vectors_config=VectorParams(size=1, distance=Distance.DOT),
+        )
+
+
+def _read_manifest(client: QdrantClient, collection_name: str) -> dict | None:
+    if not client.collection_exists(INGEST_MANIFEST_COLLECTION):
+        return None
+    records = client.retrieve(
+        collection_name=INGEST_MANIFEST_COLLECTION,
+        ids=[_manifest_point_id(collection_name)],
+        with_payload=True,
+    )
+    return records[0].payload if records else None
+
+
+def _write_manifest(
+    client: QdrantClient,
+    collection_name: str,
+    fingerprint: str,
+    vector_size: int,
+    num_points: int,
+    quantization: str | None = None,
+) -> None:
+    _ensure_manifest_collection(client)
+    client.upsert(
+        collection_name=INGEST_MANIFEST_COLLECTION,
+        points=[
+            PointStruct(
+                id=_manifest_point_id(collection_name),
+                vector=[0.0],
+                payload={
+                    "collection_name": collection_name,
+                    "fingerprint": fingerprint,
+                    "config": _collection_config(vector_size, quantization),
+                    "num_points": num_points,
+                },
+            )
+        ],
+        wait=True,
+    )
+
+
+def collection_is_current(
+    client: QdrantClient,
+    collection_name: str,
+    fingerprint: str,
+    vector_size: int = EMBEDDING_VECTOR_SIZE,
+    quantization: str | None = None,
+) -> bool:
+    """
+    Check whether a persisted collection was built from the same source file
+    and vector config, so it can be reused instead of rebuilt.
+
+    :param collection_name: Name of the collection.
+    :param fingerprint: Fingerprint of the source file to be ingested.
+    :param vector_size: Dimension of the vectors.
+    :param quantization: Quantization type of the collection, if any.
+    :return: True if the stored collection is up to date.
+    """
+    if not client.collection_exists(collection_name):
+        return False
+
+    manifest = _read_manifest(client, collection_name)
+    if manifest is None:
+        return False
+    if manifest.get("fingerprint") != fingerprint:
+        return False
+    if manifest.get("config") != _collection_config(vector_size, quantization):
+        return False
+
+    # Guard against a collection that was emptied or partially written
+    # after the manifest entry was recorded.
+    num_points = client.count(collection_name=collection_name, exact=True).count
+    return num_points == manifest.get("num_points")
+
 
 def _create_collection(
-    client: QdrantClient, collection_name: str, vector_size: int
+    client: QdrantClient, collection_name: str, vector_size: int, quantization: str | None = None
 ) -> None:
     """
-    Creates a Qdrant collection with the given parameters.
+    Creates a Qdrant collection with the given parameters, dropping any
+    existing collection of the same name.
     :param collection_name: Name of the collection.
     :param vector_size: Dimension of the vectors.
+    :param quantization: Quantization type: "scalar", "binary", "product" or None.
     """
-    client.recreate_collection(
+    if client.collection_exists(collection_name):
+        client.delete_collection(collection_name=collection_name)
+    client.create_collection(
         collection_name=collection_name,
         vectors_config=VectorParams(
-            size=vector_size, distance=Distance.COSINE),
+            size=vector_size, distance=Distance.COSINE, on_disk=quantization is not None),
+        quantization_config=_quantization_config(quantization),
     )
 
 
+def _collection_has_config(
+    client: QdrantClient, collection_name: str, vector_size: int, quantization: str | None = None
+) -> bool:
+    """Check that an existing collection was created with the expected vector config."""
+    if not client.collection_exists(collection_name):
+        return False
+    config = client.get_collection(collection_name).config
+    vectors = config.params.vectors
+    return (
+        isinstance(vectors, VectorParams)
+        and vectors.size == vector_size
+        and vectors.distance == Distance.COSINE
+        and _quantization_type(config.quantization_config) == quantization
+    )
+
+
+def _existing_point_ids(client: QdrantClient, collection_name: str, batch_size: int = 1000) -> set[str]:
+    """Scroll through a collection and collect the IDs of all stored points."""
+    ids: set[str] = set()
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        ids.update(str(record.id) for record in records)
+        if offset is None:
+            return ids
+
+
+def _batched(items: Iterable, batch_size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def _upsert_batches(
+    client: QdrantClient,
+    collection_name: str,
+    batches: Iterator[Batch],
+    num_batches: int,
+    parallel: int,
+) -> None:
+    """
+    Upsert batches of points with up to `parallel` requests in flight.
+
+    Batches are sent with `wait=False`, so Qdrant acknowledges them once they
+    are written to its WAL. The final batch is sent with `wait=True` after all
+    others were acknowledged; since Qdrant applies updates in order, its
+    completion acts as a consistency barrier for the whole upload.
+    """
+    pending: set[Future] = set()
+    completed = 0
+
+    def _log_progress() -> None:
+        nonlocal completed
+        completed += 1
+        logger.info(
+            "Uploaded batch.",
+            collection_name=collection_name,
+            batch=completed,
+            num_batches=num_batches,
+        )
+
+    def _collect(done: set[Future]) -> None:
+        for future in done:
+            future.result()
+            _log_progress()
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        last_batch = next(batches, None)
+        for batch in batches:
+            if len(pending) >= parallel:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done)
+            pending.add(
+                executor.submit(
+                    client.upsert,
+                    collection_name=collection_name,
+                    points=last_batch,
+                    wait=False,
+                )
+            )
+            last_batch = batch
+        _collect(wait(pending).done)
+
+    if last_batch is not None:
+        client.upsert(collection_name=collection_name, points=last_batch, wait=True)
+        _log_progress()
+
+
 def generate_collection(
-    df_docs: pd.DataFrame,
+    corpus: EmbeddingCorpus,
     qdrant_client: QdrantClient,
-    qdrant_collection_name: str
+    qdrant_collection_name: str,
+    fingerprint: str | None = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+    parallel: int = INGEST_PARALLEL_BATCHES,
+    quantization: str | None = None,
 ) -> None:
-    """Routine for generating a Qdrant collection for a specific CSV file type."""
-    _create_collection(
-        # qdrant_client, retriever_config.collection_name, retriever_config.vector_size
-        qdrant_client, qdrant_collection_name, 768
-    )
-    logger.info(
-        # "Created the collection.", collection_name=retriever_config.collection_name
-        "Created the collection.", collection_name=qdrant_collection_name
-    )
+    """
+    Routine for generating a Qdrant collection from a loaded embedding corpus.
 
-    points = []
-    for idx, (_, row) in enumerate(
-        df_docs.iterrows(), start=1
-    ):  # Using _ for unused variable
-        content = row["chunk"]
+    An existing collection with the same vector config is updated
+    incrementally: only chunks whose point ID is not stored yet are upserted
+    and points no longer present in the source are deleted.
 
-        if not isinstance(content, str):
-            logger.warning(
-                "Skipping document due to missing or invalid content.",
-                filename=row["page_url"],
-            )
-            continue
+    Points are uploaded in batches of `batch_size` with up to `parallel`
+    batches in flight, so memory stays bounded by the batches being sent.
 
-        payload = {
-            "page_url": row["page_url"],
-            "page_title": row["page_title"],
-            "page_description": row["page_description"],
-            "text": content,
-        }
+    If a fingerprint of the source file is given it is recorded in the ingest
+    manifest so that later boots can reuse the collection.
 
-        point = PointStruct(
-            id=idx,  # Using integer ID starting from 1
-            vector=row["embedding"],
-            payload=payload,
+    A collection whose vector config or quantization type differs is
+    recreated from scratch.
+    """
+    check_quantization(quantization)
+    # Point ID -> row position in the corpus; identical chunks collapse onto
+    # a single point
+    chunks: dict[str, int] = {}
+    hashes: list[str] = []
+    for position in range(len(corpus)):
+        chunk_hash = content_hash(corpus.payload(position), corpus.embeddings[position])
+        hashes.append(chunk_hash)
+        idx = point_id(
+            corpus.page_url[position], int(corpus.chunk_number[position]), chunk_hash
+        )
+        chunks[idx] = position
+
+    if _collection_has_config(qdrant_client, qdrant_collection_name, EMBEDDING_VECTOR_SIZE, quantization):
+        existing_ids = _existing_point_ids(qdrant_client, qdrant_collection_name)
+        logger.info(
+            "Updating existing collection.", collection_name=qdrant_collection_name
+        )
+    else:
+        _create_collection(
+            # qdrant_client, retriever_config.collection_name, retriever_config.vector_size
+            qdrant_client, qdrant_collection_name, EMBEDDING_VECTOR_SIZE, quantization
+        )
+        existing_ids = set()
+        logger.info(
+            # "Created the collection.", collection_name=retriever_config.collection_name
+            "Created the collection.", collection_name=qdrant_collection_name
         )
-        points.append(point)
 
-    if points:
-        qdrant_client.upsert(
-            # collection_name=retriever_config.collection_name,  # noqa: ERA001
+    new_ids = [idx for idx in chunks if idx not in existing_ids]
+    removed_ids = sorted(existing_ids - chunks.keys())
+
+    def _to_batch(ids: list[str]) -> Batch:
+        positions = [chunks[idx] for idx in ids]
+        return Batch(
+            ids=ids,
+            vectors=corpus.embeddings[positions].tolist(),
+            payloads=[
+                {**corpus.payload(position), "content_hash": hashes[position]}
+                for position in positions
+            ],
+        )
+
+    _upsert_batches(
+        qdrant_client,
+        qdrant_collection_name,
+        map(_to_batch, _batched(new_ids, batch_size)),
+        num_batches=-(-len(new_ids) // batch_size),
+        parallel=parallel,
+    )
+    if removed_ids:
+        qdrant_client.delete(
             collection_name=qdrant_collection_name,
-            points=points,
+            points_selector=PointIdsList(points=removed_ids),
+            wait=True,
         )
+
+    if chunks:
         logger.info(
             "Collection generated and documents inserted into Qdrant successfully.",
             collection_name=qdrant_collection_name,
-            num_points=len(points),
+            num_points=len(chunks),
+            num_upserted=len(new_ids),
+            num_deleted=len(removed_ids),
         )
     else:
         logger.warning("No valid documents found to insert.")
 
+    if fingerprint is not None:
+        _write_manifest(
+            qdrant_client,
+            qdrant_collection_name,
+            fingerprint,
+            EMBEDDING_VECTOR_SIZE,
+            len(chunks),
+            quantization,
+        )
+
+
+class QdrantVectorStore(VectorStore):
+    """
+    Vector store backed by a Qdrant server.
+
+    Searches from the event loop go through `async_client` when one is
+    given, and through `qdrant_client` in a worker thread otherwise.
+    """
+
+    def __init__(
+        self, qdrant_client: QdrantClient, async_client: AsyncQdrantClient | None = None
+    ) -> None:
+        self.qdrant_client = qdrant_client
+        self.async_client = async_client
+
+    def wait_until_available(self, timeout: float, interval: float = 0.5) -> None:
+        """Poll Qdrant until it answers, raising the last error after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.qdrant_client.get_collections()
+                return
+            except Exception:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(interval)
+
+    def is_current(
+        self, collection_name: str, fingerprint: str, quantization: str | None = None
+    ) -> bool:
+        return collection_is_current(
+            self.qdrant_client, collection_name, fingerprint, quantization=quantization
+        )
+
+    def add_corpus(
+        self,
+        collection_name: str,
+        corpus: EmbeddingCorpus,
+        fingerprint: str | None = None,
+        quantization: str | None = None,
+    ) -> None:
+        generate_collection(
+            corpus,
+            self.qdrant_client,
+            collection_name,
+            fingerprint=fingerprint,
+            quantization=quantization,
+        )
+
+    def search(self, collection_name: str, query_vector: list[float], top_k: int) -> list[dict]:
+        # Search Qdrant for similar vectors.
+        results = self.qdrant_client.search(
+            collection_name=collection_name,
+            query_vector=query_vector,
+            limit=top_k,
+            search_params=_SEARCH_PARAMS,
+        )
+        return [_hit_to_result(hit) for hit in results]
+
+    def search_many(
+        self, collection_names: list[str], query_vector: list[float], top_k: int
+    ) -> dict[str, list[dict]]:
+        # Qdrant batches searches within a single collection only, so the
+        # per-collection requests are sent concurrently instead
+        if len(collection_names) <= 1:
+            return super().search_many(collection_names, query_vector, top_k)
+        with ThreadPoolExecutor(max_workers=len(collection_names)) as executor:
+            futures = {
+                collection_name: executor.submit(self.search, collection_name, query_vector, top_k)
+                for collection_name in collection_names
+            }
+            return {collection_name: future.result() for collection_name, future in futures.items()}
+
+    async def search_async(
+        self, collection_name: str, query_vector: list[float], top_k: int
+    ) -> list[dict]:
+        if self.async_client is None:
+            return await super().search_async(collection_name, query_vector, top_k)
+        results = await self.async_client.search(
+            collection_name=collection_name,
+            query_vector=query_vector,
+            limit=top_k,
+            search_params=_SEARCH_PARAMS,
+        )
+        return [_hit_to_result(hit) for hit in results]
+
+    async def search_many_async(
+        self, collection_names: list[str], query_vector: list[float], top_k: int
+    ) -> dict[str, list[dict]]:
+        if self.async_client is None:
+            return await super().search_many_async(collection_names, query_vector, top_k)
+        results = await asyncio.gather(*(
+            self.search_async(collection_name, query_vector, top_k)
+            for collection_name in collection_names
+        ))
+        return dict(zip(collection_names, results))
+
+
+# Only takes effect on quantized collections: search the quantized vectors,
+# then rescore the oversampled candidates with the originals
+_SEARCH_PARAMS = SearchParams(
+    quantization=QuantizationSearchParams(rescore=True, oversampling=QUANTIZATION_OVERSAMPLING)
+)
+
+
+def _hit_to_result(hit: ScoredPoint) -> dict:
+    """Convert a Qdrant search hit into a search result dictionary."""
+    if hit.payload:
+        text = hit.payload.get("text", "")
+        metadata = {
+            field: value
+            for field, value in hit.payload.items()
+            if field != "text"
+        }
+    else:
+        text = ""
+        metadata = ""
+    return {"text": text, "score": hit.score, "metadata": metadata}
+
+
+def _merge_federated_results(
+    results: dict[str, list[dict]], top_k: int, margin_weight: float = FEDERATED_MARGIN_WEIGHT
+) -> list[dict]:
+    """
+    Merge per-collection hits, searched with `top_k + 1` results each, into
+    one ranking by a blend of their raw similarity, scaled between the
+    lowest collection baseline and the best hit, and their margin over the
+    last hit of their own collection, scaled by the largest margin.
+    """
+    merged = []
+    baselines = []
+    for collection_name, hits in results.items():
+        if not hits:
+            continue
+        baseline = hits[-1]["score"]
+        baselines.append(baseline)
+        for hit in hits[:top_k]:
+            merged.append({**hit, "collection": collection_name, "margin": max(hit["score"] - baseline, 0.0)})
+    if not merged:
+        return []
+
+    floor = min(baselines)
+    score_range = max(hit["score"] for hit in merged) - floor
+    margin_range = max(hit["margin"] for hit in merged)
+    for hit in merged:
+        relevance = (hit["score"] - floor) / score_range if score_range > 0 else 1.0
+        margin = hit.pop("margin")
+        margin = margin / margin_range if margin_range > 0 else 0.0
+        hit["normalized_score"] = (1 - margin_weight) * relevance + margin_weight * margin
+    merged.sort(key=lambda hit: (hit["normalized_score"], hit["score"]), reverse=True)
+    return merged[:top_k]
+
 
-def semantic_search(qdrant_client: QdrantClient, query: str, collection_name: str, top_k: int = 5) -> list[dict]:
+def semantic_search(
+    vector_store: VectorStore,
+    query: str,
+    collection_name: str,
+    top_k: int = 5,
+    query_vector: list[float] | None = None,
+) -> list[dict]:
     """
     Perform semantic search by converting the query into a vector
-    and searching in Qdrant.
+    and searching the vector store.
 
     :param query: The input query.
     :param top_k: Number of top results to return.
+    :param query_vector: Embedding of the query, if already computed.
     :return: A list of dictionaries, each representing a retrieved document.
     """
-    # Convert the query into a vector embedding using Gemini
-    query_vector = embed_content(
-        contents=query
-    )
+    if query_vector is None:
+        # Convert the query into a vector embedding using Gemini
+        query_vector = embed_content(
+            contents=query
+        )
 
-    logger.debug("User query embedding generated")
+        logger.debug("User query embedding generated")
 
-    # Search Qdrant for similar vectors.
-    results = qdrant_client.search(
-        collection_name=collection_name,
-        query_vector=query_vector,
-        limit=top_k,
-    )
+    return vector_store.search(collection_name, query_vector, top_k)
 
-    # Process and return results.
-    output = []
-    for hit in results:
-        if hit.payload:
-            text = hit.payload.get("text", "")
-            metadata = {
-                field: value
-                for field, value in hit.payload.items()
-                if field != "text"
-            }
-        else:
-            text = ""
-            metadata = ""
-        output.append(
-            {"text": text, "score": hit.score, "metadata": metadata})
-    return output
+
+def federated_search(
+    vector_store: VectorStore,
+    query: str,
+    collection_names: list[str],
+    top_k: int = 8,
+    query_vector: list[float] | None = None,
+) -> list[dict]:
+    """
+    Search several collections with a single query embedding and merge the
+    hits into one ranking.
+
+    Raw cosine scores are only roughly comparable across collections, since
+    chunking and vocabulary shift each collection's score range. Every
+    collection is searched for one more hit than requested, and its last hit
+    serves as that collection's baseline. Hits are ranked mostly by their raw
+    similarity, scaled to [0, 1] across the merged results, so that a weakly
+    matching collection never outranks a strongly matching one, blended with
+    FEDERATED_MARGIN_WEIGHT of their margin over their own baseline, which
+    favours hits that stand out within their collection.
+
+    :param query: The input query.
+    :param collection_names: Collections to search.
+    :param top_k: Number of results to return across all collections.
+    :param query_vector: Embedding of the query, if already computed.
+    :return: The merged results, each tagged with its "collection" and its
+        "normalized_score".
+    """
+    if not collection_names or top_k <= 0:
+        return []
+
+    if query_vector is None:
+        query_vector = embed_content(
+            contents=query
+        )
+
+        logger.debug("User query embedding generated")
+
+    results = vector_store.search_many(collection_names, query_vector, top_k + 1)
+    return _merge_federated_results(results, top_k)
+
+
+async def semantic_search_async(
+    vector_store: VectorStore,
+    query: str,
+    collection_name: str,
+    top_k: int = 5,
+    query_vector: list[float] | None = None,
+) -> list[dict]:
+    """
+    `semantic_search` without blocking the event loop.
+
+    :param query: The input query.
+    :param top_k: Number of top results to return.
+    :param query_vector: Embedding of the query, if already computed.
+    :return: A list of dictionaries, each representing a retrieved document.
+    """
+    if query_vector is None:
+        query_vector = await embed_content_async(query)
+        logger.debug("User query embedding generated")
+
+    return await vector_store.search_async(collection_name, query_vector, top_k)
+
+
+async def federated_search_async(
+    vector_store: VectorStore,
+    query: str,
+    collection_names: list[str],
+    top_k: int = 8,
+    query_vector: list[float] | None = None,
+) -> list[dict]:
+    """
+    `federated_search` without blocking the event loop.
+
+    :param query: The input query.
+    :param collection_names: Collections to search.
+    :param top_k: Number of results to return across all collections.
+    :param query_vector: Embedding of the query, if already computed.
+    :return: The merged results, each tagged with its "collection" and its
+        "normalized_score".
+    """
+    if not collection_names or top_k <= 0:
+        return []
+
+    if query_vector is None:
+        query_vector = await embed_content_async(query)
+        logger.debug("User query embedding generated")
+
+    results = await vector_store.search_many_async(collection_names, query_vector, top_k + 1)
+    return _merge_federated_results(results, top_k)
@@ -0,0 +1,124 @@
+"""
+Local routing of queries to collections and tools
+
+Picks the collections and tools a query needs without a model turn: the
+query embedding is scored against the centroid of every collection,
+computed at ingest, and keyword rules catch names and topics that the
+embedding alone may not single out.
+"""
+
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+# Collections whose centroid similarity is within this margin of the best
+# one are routed to as well
+QUERY_ROUTER_MARGIN = float(os.getenv("QUERY_ROUTER_MARGIN", "0.05"))
+
+
+@dataclass(frozen=True)
+class KeywordRule:
+    """
+    Routes every query matching `pattern` to `collections` and `tools`,
+    whatever the centroid scores say.
+    """
+
+    pattern: re.Pattern
+    collections: tuple[str, ...] = ()
+    tools: tuple[str, ...] = ()
+
+
+@dataclass
+class Route:
+    """
+    Collections and tools selected for a query.
+
+    Attributes:
+        collections (list[str]): Collections to search, in the order they were offered.
+        tools (list[str]): Tools other than retrieval the query needs.
+        keyword_collections (list[str]): Collections named by the keyword rules.
+        scores (dict[str, float]): Cosine similarity of the query to each collection centroid.
+        keywords (list[str]): Patterns of the keyword rules that matched.
+    """
+
+    collections: list[str]
+    tools: list[str] = field(default_factory=list)
+    keyword_collections: list[str] = field(default_factory=list)
+    scores: dict[str, float] = field(default_factory=dict)
+    keywords: list[str] = field(default_factory=list)
+
+
+class QueryRouter:
+    """
+    Selects collections by the similarity of the query to each collection
+    centroid, plus the collections and tools of the matching keyword rules.
+
+    The best scoring collection is always selected, along with the ones
+    within `margin` of it. Collections without a centroid yet are never
+    ruled out.
+    """
+
+    def __init__(self, rules: list[KeywordRule] | None = None, margin: float = QUERY_ROUTER_MARGIN) -> None:
+        self.rules = list(rules or [])
+        self.margin = margin
+        self._centroids: dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def set_centroid(self, collection_name: str, centroid: np.ndarray) -> None:
+        """Record the centroid embedding of a collection."""
+        centroid = np.asarray(centroid, dtype=np.float32)
+        norm = np.linalg.norm(centroid)
+        with self._lock:
+            self._centroids[collection_name] = centroid / norm if norm else centroid
+
+    def route(self, query: str, query_vector: list[float] | None, collection_names: list[str]) -> Route:
+        """
+        Select among `collection_names` the collections, and the tools, for a
+        query. Without `query_vector` only the keyword rules are applied and
+        every collection they do not rule in is kept.
+        """
+        keyword_collections: set[str] = set()
+        tools: list[str] = []
+        keywords: list[str] = []
+        for rule in self.rules:
+            if rule.pattern.search(query):
+                keywords.append(rule.pattern.pattern)
+                keyword_collections.update(rule.collections)
+                tools.extend(tool for tool in rule.tools if tool not in tools)
+
+        selected = set(keyword_collections)
+        with self._lock:
+            centroids = {
+                name: self._centroids[name]
+                for name in collection_names
+                if name in self._centroids and query_vector is not None
+            }
+        selected.update(name for name in collection_names if name not in centroids)
+
+        scores: dict[str, float] = {}
+        if centroids:
+            vector = np.asarray(query_vector, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            similarities = np.stack(list(centroids.values())) @ (vector / norm if norm else vector)
+            best = float(similarities.max())
+            for name, similarity in zip(centroids, similarities.tolist()):
+                scores[name] = similarity
+                if similarity >= best - self.margin:
+                    selected.add(name)
+
+        route = Route(
+            collections=[name for name in collection_names if name in selected],
+            tools=tools,
+            keyword_collections=[name for name in collection_names if name in keyword_collections],
+            scores=scores,
+            keywords=keywords,
+        )
+        logger.debug("Query routed", collections=route.collections, tools=route.tools,
+                     scores=route.scores, keywords=route.keywords)
+        return route
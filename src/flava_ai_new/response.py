@@ -15,29 +15,49 @@ from .PROMPTS import RESPONDER_PROMPT
 logger = structlog.get_logger(__name__)
 
 
-def generate_response(gemini_model: GenerativeModel, query: str, retrieved_documents: list[dict]) -> str:
-    """
-    Generate a final answer using the query and the retrieved context.
-
-    :param query: The input query.
-    :param retrieved_documents: A list of dictionaries containing retrieved docs.
-    :return: The generated answer as a string.
-    """
+def _build_prompt(query: str, retrieved_documents: list[dict]) -> str:
     context = "List of retrieved documents:\n"
 
     # Build context from the retrieved documents.
     for idx, doc in enumerate(retrieved_documents, start=1):
         # identifier = doc.get("metadata", {}).get("filename", f"Doc{idx}")  # noqa: ERA001
-        identifier = doc.get("metadata", {}).get("page_url", f"URL{idx}")
+        identifier = (doc.get("metadata") or {}).get("page_url", f"URL{idx}")
         # context += f"Document {identifier}:\n{doc.get('text', '')}\n\n"  # noqa: ERA001
         context += f"URL {identifier}:\n{doc.get('text', '')}\n\n"
 
     # Compose the prompt
-    prompt = context + \
+    return context + \
         f"User query: {query}\n" + RESPONDER_PROMPT
 
+
+def generate_response(gemini_model: GenerativeModel, query: str, retrieved_documents: list[dict]) -> str:
+    """
+    Generate a final answer using the query and the retrieved context.
+
+    :param query: The input query.
+    :param retrieved_documents: A list of dictionaries containing retrieved docs.
+    :return: The generated answer as a string.
+    """
     response = gemini_model.generate_content(
-        prompt,
+        _build_prompt(query, retrieved_documents),
+        generation_config=GenerationConfig(),
+    )
+
+    return response.text
+
+
+async def generate_response_async(
+    gemini_model: GenerativeModel, query: str, retrieved_documents: list[dict]
+) -> str:
+    """
+    `generate_response` without blocking the event loop.
+
+    :param query: The input query.
+    :param retrieved_documents: A list of dictionaries containing retrieved docs.
+    :return: The generated answer as a string.
+    """
+    response = await gemini_model.generate_content_async(
+        _build_prompt(query, retrieved_documents),
         generation_config=GenerationConfig(),
     )
 
@@ -0,0 +1,206 @@
+"""
+Cache of full chat answers
+
+Answers are looked up by the normalised question first, then by the
+similarity of the question embedding to the questions answered before.
+Collections are only loaded at startup, so answers are not invalidated
+when documentation changes; RESPONSE_CACHE_TTL bounds how stale they get.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import structlog
+
+from .embedding_cache import normalize_query
+
+logger = structlog.get_logger(__name__)
+
+# Answers kept; 0 disables the response cache
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+# Seconds an answer is served from the cache; 0 keeps it until evicted
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# Cosine similarity above which a different question gets the cached answer;
+# 0 disables semantic lookups
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))
+# Tools returning live data: queries that use them are never cached
+RESPONSE_CACHE_BYPASS_TOOLS = [
+    tool for tool in os.getenv("RESPONSE_CACHE_BYPASS_TOOLS", "get_validator_info").split(",") if tool
+]
+
+
+def _normalize(vector: list[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@dataclass
+class _CachedResponse:
+    response: dict
+    created_at: float
+    # L2-normalised question embedding, for semantic lookups
+    vector: np.ndarray | None
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of chat responses keyed by a scope, such as the
+    chat mode, and the normalised question.
+
+    `get` matches the question exactly, then, given the question embedding,
+    returns the answer of the most similar cached question of the same scope
+    when its cosine similarity reaches `similarity_threshold`. Entries expire
+    `ttl` seconds after they were stored, and the least recently used entry
+    is evicted once `max_size` are held.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, similarity_threshold: float = 0.95) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries: OrderedDict[tuple[str, str], _CachedResponse] = OrderedDict()
+        self._lock = threading.Lock()
+        # Stacked vectors of the entries of each scope, rebuilt after changes
+        self._index: dict[str, tuple[list[tuple[str, str]], np.ndarray]] = {}
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @property
+    def semantic(self) -> bool:
+        """Whether lookups can match similar questions, given their embedding."""
+        return self.similarity_threshold > 0
+
+    def _expired(self, entry: _CachedResponse, now: float) -> bool:
+        return self.ttl > 0 and now - entry.created_at > self.ttl
+
+    def _drop_expired(self) -> None:
+        now = time.monotonic()
+        for expired in [key for key, entry in self._entries.items() if self._expired(entry, now)]:
+            self._remove(expired)
+            self.expirations += 1
+
+    def _get_exact(self, key: tuple[str, str]) -> dict | None:
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        self.exact_hits += 1
+        return dict(self._entries[key].response)
+
+    def get_exact(self, query: str, scope: str = "") -> dict | None:
+        """
+        Return the cached response for this exact question, or None. A miss
+        is not counted, so that it can be followed by `get` with the question
+        embedding.
+        """
+        with self._lock:
+            self._drop_expired()
+            return self._get_exact((scope, normalize_query(query)))
+
+    def _remove(self, key: tuple[str, str]) -> None:
+        del self._entries[key]
+        self._index.clear()
+
+    def get(self, query: str, query_vector: list[float] | None = None, scope: str = "") -> dict | None:
+        """
+        Return the cached response for this exact question, else, with
+        `query_vector`, for the most similar question if it is similar
+        enough, or None.
+        """
+        key = (scope, normalize_query(query))
+        with self._lock:
+            self._drop_expired()
+            response = self._get_exact(key)
+            if response is not None:
+                return response
+
+            if query_vector is None or not self.semantic:
+                self.misses += 1
+                return None
+            if scope not in self._index:
+                keys = [key for key, entry in self._entries.items() if key[0] == scope and entry.vector is not None]
+                vectors = np.stack([self._entries[key].vector for key in keys]) if keys else np.empty((0, 0))
+                self._index[scope] = (keys, vectors)
+            keys, vectors = self._index[scope]
+            if not keys:
+                self.misses += 1
+                return None
+
+            similarities = vectors @ _normalize(query_vector)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(keys[best])
+            self.semantic_hits += 1
+            logger.debug("Semantic response cache hit", similarity=float(similarities[best]))
+            return dict(self._entries[keys[best]].response)
+
+    def put(
+        self,
+        query: str,
+        response: dict,
+        query_vector: list[float] | None = None,
+        scope: str = "",
+    ) -> None:
+        """
+        Store the response to a question, evicting the least recently used
+        entries. Entries without `query_vector` only match exactly.
+        """
+        if not self.enabled:
+            return
+        key = (scope, normalize_query(query))
+        entry = _CachedResponse(
+            response=dict(response),
+            created_at=time.monotonic(),
+            vector=None if query_vector is None else _normalize(query_vector),
+        )
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._index.clear()
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int | float]:
+        """Entry count, hit/miss counters and the hit rate."""
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+response_cache = ResponseCache(
+    max_size=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    similarity_threshold=RESPONSE_CACHE_SIMILARITY,
+)
@@ -0,0 +1,138 @@
+"""
+Per-run retrieval state shared by the tools of an agent run
+"""
+
+import asyncio
+import json
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from typing import TypeVar
+
+import structlog
+
+from .embedding import embed_content_async
+from .qdrant import federated_search_async
+from .vector_store import VectorStore
+
+logger = structlog.get_logger(__name__)
+
+T = TypeVar("T")
+
+
+def split_conversation(message: str) -> tuple[str, bool]:
+    """
+    The last user turn of a chat message, and whether other turns come with it.
+
+    The frontend sends a JSON array of {"role", "content"} turns ending with
+    the new question; any other message is taken as a single question.
+    """
+    try:
+        turns = json.loads(message)
+    except ValueError:
+        return message, False
+    if not isinstance(turns, list) or not all(isinstance(turn, dict) for turn in turns):
+        return message, False
+    user_turns = [
+        turn["content"] for turn in turns
+        if turn.get("role") == "user" and isinstance(turn.get("content"), str)
+    ]
+    if not user_turns:
+        return message, False
+    return user_turns[-1], len(turns) > 1
+
+
+@dataclass
+class RetrievalContext:
+    """
+    Dependencies of one agent run: the user query, with its embedding and
+    search results memoized so that every tool call and retry of the run,
+    and of the sub-agents it is passed to, embeds the query at most once and
+    runs each search at most once.
+
+    Concurrent tool calls await the same pending embedding or search. A
+    failed one is forgotten, so a retry runs it again.
+
+    Attributes:
+        query (str): The user query.
+        events (asyncio.Queue | None): Receives `(event, data)` tuples from
+            the tools as they are called, for streaming responses.
+        sub_agents (list[dict]): Status of each consensus sub-agent, filled
+            in by the consensus agent.
+        context_chunks (list[dict]): References to the chunks the consensus
+            sub-agents were given.
+        retrieved (list[dict]): Chunks returned by the searches of the run.
+        tool_calls (list[str]): Names of the tools called during the run.
+    """
+
+    query: str
+    events: asyncio.Queue | None = None
+    sub_agents: list[dict] = field(default_factory=list)
+    context_chunks: list[dict] = field(default_factory=list)
+    retrieved: list[dict] = field(default_factory=list)
+    tool_calls: list[str] = field(default_factory=list)
+    _tasks: dict[tuple, asyncio.Task] = field(default_factory=dict, init=False, repr=False)
+
+    def notify(self, event: str, data: dict) -> None:
+        """
+        Report a tool event to the listener of the run, if there is one,
+        recording the names of the tools called.
+        """
+        if event == "tool_call":
+            self.tool_calls.append(data["tool"])
+        if self.events is not None:
+            self.events.put_nowait((event, data))
+
+    async def memoized(self, key: tuple, compute: Callable[[], Awaitable[T]]) -> T:
+        """Await `compute()` once per run and key, sharing the result."""
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(compute())
+        try:
+            # Shielded so that a cancelled caller does not cancel the work
+            # other tool calls are waiting on
+            return await asyncio.shield(task)
+        except Exception:
+            if self._tasks.get(key) is task and task.done():
+                del self._tasks[key]
+            raise
+
+    @property
+    def question(self) -> str:
+        """The last user turn of the query."""
+        return split_conversation(self.query)[0]
+
+    @property
+    def has_history(self) -> bool:
+        """Whether the query carries earlier turns of the conversation."""
+        return split_conversation(self.query)[1]
+
+    async def query_vector(self) -> list[float]:
+        """Embedding of the query, computed on first use."""
+        return await self.memoized(("query_vector",), lambda: embed_content_async(self.query))
+
+    async def question_vector(self) -> list[float]:
+        """Embedding of the last user turn alone, computed on first use."""
+        if self.question == self.query:
+            return await self.query_vector()
+        return await self.memoized(("question_vector",), lambda: embed_content_async(self.question))
+
+    async def federated_search(
+        self, vector_store: VectorStore, collection_names: list[str], top_k: int
+    ) -> list[dict]:
+        """Memoized `qdrant.federated_search_async` of the query."""
+
+        async def search() -> list[dict]:
+            results = await federated_search_async(
+                vector_store=vector_store,
+                query=self.query,
+                collection_names=collection_names,
+                top_k=top_k,
+                query_vector=await self.query_vector(),
+            )
+            self.retrieved.extend(results)
+            return results
+
+        key = ("federated_search", tuple(sorted(collection_names)), top_k)
+        if key in self._tasks:
+            logger.debug("Reusing search results of this run", collections=collection_names)
+        return await self.memoized(key, search)
@@ -0,0 +1,300 @@
+"""
+Vector store backends used for retrieval
+
+Two backends implement the VectorStore interface: the Qdrant server
+(qdrant.QdrantVectorStore) and EmbeddedVectorStore, which keeps every
+collection in process memory and searches it with NumPy.
+"""
+
+import asyncio
+import math
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+
+import numpy as np
+import structlog
+
+from .corpus import EmbeddingCorpus, content_hash, point_id
+
+try:
+    import hnswlib
+except ImportError:  # optional, only needed for VECTOR_STORE_HNSW
+    hnswlib = None
+
+logger = structlog.get_logger(__name__)
+
+QUANTIZATION_TYPES = ("scalar", "binary", "product")
+
+# Candidates fetched from quantized vectors per requested result, which are
+# then rescored with the original vectors
+QUANTIZATION_OVERSAMPLING = float(os.getenv("QUANTIZATION_OVERSAMPLING", "2.0"))
+
+
+def check_quantization(quantization: str | None) -> None:
+    """Raise ValueError for an unknown quantization type."""
+    if quantization is not None and quantization not in QUANTIZATION_TYPES:
+        msg = f"Unknown quantization type: {quantization}"
+        raise ValueError(msg)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalise the rows of a matrix into a new float32 array."""
+    vectors = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    vectors /= np.where(norms == 0, 1, norms)
+    return vectors
+
+
+def _spill_to_disk(vectors: np.ndarray, block_size: int = 8192) -> np.memmap:
+    """
+    Copy a matrix into a memory map backed by an unlinked temporary file, so
+    that its pages can be dropped from RAM and read back on demand.
+    """
+    spill = np.memmap(tempfile.TemporaryFile(), dtype=vectors.dtype, mode="w+", shape=vectors.shape)
+    for start in range(0, len(vectors), block_size):
+        spill[start:start + block_size] = vectors[start:start + block_size]
+    spill.flush()
+    return spill
+
+
+class VectorStore(ABC):
+    """
+    Stores the document collections and answers nearest-neighbour queries.
+
+    Search results are dictionaries with the chunk "text", its similarity
+    "score" and the remaining payload fields as "metadata".
+    """
+
+    def wait_until_available(self, timeout: float) -> None:
+        """Block until the backend can serve requests."""
+
+    @abstractmethod
+    def is_current(
+        self, collection_name: str, fingerprint: str, quantization: str | None = None
+    ) -> bool:
+        """
+        Whether the collection is already loaded from the dataset with this
+        fingerprint and the given quantization type.
+        """
+
+    @abstractmethod
+    def add_corpus(
+        self,
+        collection_name: str,
+        corpus: EmbeddingCorpus,
+        fingerprint: str | None = None,
+        quantization: str | None = None,
+    ) -> None:
+        """
+        Create or update a collection from a loaded corpus.
+
+        `quantization` is one of QUANTIZATION_TYPES or None. Quantized
+        collections are searched on compressed vectors and the best
+        candidates are rescored with the original vectors.
+        """
+
+    @abstractmethod
+    def search(self, collection_name: str, query_vector: list[float], top_k: int) -> list[dict]:
+        """Return the `top_k` chunks most similar to `query_vector`."""
+
+    def search_many(
+        self, collection_names: list[str], query_vector: list[float], top_k: int
+    ) -> dict[str, list[dict]]:
+        """
+        Search several collections with the same query vector, returning the
+        `top_k` chunks of each collection keyed by collection name.
+        """
+        return {
+            collection_name: self.search(collection_name, query_vector, top_k)
+            for collection_name in collection_names
+        }
+
+    async def search_async(
+        self, collection_name: str, query_vector: list[float], top_k: int
+    ) -> list[dict]:
+        """
+        `search` without blocking the event loop. Runs `search` in a worker
+        thread unless the backend has a native async client.
+        """
+        return await asyncio.to_thread(self.search, collection_name, query_vector, top_k)
+
+    async def search_many_async(
+        self, collection_names: list[str], query_vector: list[float], top_k: int
+    ) -> dict[str, list[dict]]:
+        """`search_many` without blocking the event loop."""
+        return await asyncio.to_thread(self.search_many, collection_names, query_vector, top_k)
+
+
+@dataclass
+class _EmbeddedCollection:
+    corpus: EmbeddingCorpus
+    # Positions in the corpus of the searchable rows, after deduplication
+    positions: np.ndarray
+    fingerprint: str | None
+    quantization: str | None = None
+    # L2-normalised float32 vectors, so that cosine similarity is a dot
+    # product. Not kept for quantized collections.
+    vectors: np.ndarray | None = None
+    # int8 codes for scalar quantization, packed sign bits for binary
+    codes: np.ndarray | None = None
+    index: "hnswlib.Index | None" = None
+
+
+class EmbeddedVectorStore(VectorStore):
+    """
+    In-process vector store.
+
+    Collections are held as normalised float32 matrices and searched exactly
+    with a single matrix-vector product and a partial sort, which is fast for
+    corpora of tens of thousands of chunks. With `hnsw=True` and hnswlib
+    installed an approximate HNSW index is built as well.
+
+    Quantized collections only keep int8 (scalar) or 1-bit (binary) codes in
+    memory; rescoring reads the original vectors from a memory map. That is
+    the snapshot's vector file when the corpus was loaded from a snapshot;
+    vectors parsed from JSON are first copied to a temporary file (in
+    TMPDIR), so the float32 matrix is not held in RAM. Product quantization
+    is only supported by the Qdrant backend and falls back to unquantized
+    vectors here.
+    """
+
+    # Rows converted to float32 at a time when scoring int8 codes
+    _SCORE_BLOCK_SIZE = 8192
+
+    def __init__(self, hnsw: bool = False, hnsw_ef: int = 64) -> None:
+        if hnsw and hnswlib is None:
+            logger.warning("hnswlib is not installed, falling back to exact search")
+            hnsw = False
+        self.hnsw = hnsw
+        self.hnsw_ef = hnsw_ef
+        self._collections: dict[str, _EmbeddedCollection] = {}
+        self._lock = threading.Lock()
+
+    def is_current(
+        self, collection_name: str, fingerprint: str, quantization: str | None = None
+    ) -> bool:
+        collection = self._collections.get(collection_name)
+        return (
+            collection is not None
+            and collection.fingerprint == fingerprint
+            and collection.quantization == quantization
+        )
+
+    def add_corpus(
+        self,
+        collection_name: str,
+        corpus: EmbeddingCorpus,
+        fingerprint: str | None = None,
+        quantization: str | None = None,
+    ) -> None:
+        check_quantization(quantization)
+        if quantization == "product":
+            logger.warning(
+                "Product quantization is not supported by the embedded vector store, "
+                "storing unquantized vectors.",
+                collection_name=collection_name,
+            )
+            quantization = None
+
+        # Identical chunks collapse onto a single row, keyed by the same
+        # point ID as in Qdrant
+        unique: dict[str, int] = {}
+        for position in range(len(corpus)):
+            chunk_hash = content_hash(corpus.payload(position), corpus.embeddings[position])
+            unique[point_id(corpus.page_url[position], int(corpus.chunk_number[position]), chunk_hash)] = position
+        positions = np.fromiter(unique.values(), dtype=np.int64, count=len(unique))
+
+        collection = _EmbeddedCollection(
+            corpus=corpus,
+            positions=positions,
+            fingerprint=fingerprint,
+            quantization=quantization,
+        )
+        if quantization in ("scalar", "binary") and not isinstance(corpus.embeddings, np.memmap):
+            # Only the candidates are read back when rescoring
+            collection.corpus = replace(corpus, embeddings=_spill_to_disk(corpus.embeddings))
+        vectors = _normalize(corpus.embeddings[positions])
+        if quantization == "scalar":
+            # Symmetric int8 range covering 99% of the components
+            bound = float(np.quantile(np.abs(vectors), 0.99)) or 1.0
+            collection.codes = np.clip(np.rint(vectors * (127 / bound)), -127, 127).astype(np.int8)
+        elif quantization == "binary":
+            collection.codes = np.packbits(vectors > 0, axis=1)
+        else:
+            collection.vectors = vectors
+            if self.hnsw and len(vectors):
+                index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+                index.init_index(max_elements=len(vectors), ef_construction=200, M=16)
+                index.add_items(vectors, np.arange(len(vectors)))
+                index.set_ef(max(self.hnsw_ef, 1))
+                collection.index = index
+        del vectors
+
+        with self._lock:
+            self._collections[collection_name] = collection
+        logger.info(
+            "Collection loaded into the embedded vector store.",
+            collection_name=collection_name,
+            num_points=len(positions),
+            quantization=quantization,
+        )
+
+    def search(self, collection_name: str, query_vector: list[float], top_k: int) -> list[dict]:
+        collection = self._collections[collection_name]
+        num_vectors = len(collection.positions)
+        top_k = min(top_k, num_vectors)
+        if top_k <= 0:
+            return []
+
+        query = _normalize(query_vector)
+
+        if collection.quantization is not None:
+            rows, scores = self._search_quantized(collection, query, top_k)
+        elif collection.index is not None:
+            labels, distances = collection.index.knn_query(query, k=top_k)
+            rows = labels[0]
+            # hnswlib reports inner product distance as 1 - similarity
+            scores = 1 - distances[0]
+        else:
+            similarities = collection.vectors @ query
+            rows = np.argpartition(-similarities, top_k - 1)[:top_k]
+            rows = rows[np.argsort(-similarities[rows])]
+            scores = similarities[rows]
+
+        output = []
+        for row, score in zip(rows, scores):
+            payload = collection.corpus.payload(int(collection.positions[row]))
+            text = payload.pop("text")
+            output.append({"text": text, "score": float(score), "metadata": payload})
+        return output
+
+    def _search_quantized(
+        self, collection: _EmbeddedCollection, query: np.ndarray, top_k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Rank all rows by their quantized codes, then rescore the oversampled
+        best candidates with the original vectors.
+        """
+        codes = collection.codes
+        if collection.quantization == "binary":
+            # Fewer differing sign bits means a smaller angle
+            approx = -np.bitwise_count(codes ^ np.packbits(query > 0)).sum(axis=1, dtype=np.int32)
+        else:
+            approx = np.concatenate([
+                codes[start:start + self._SCORE_BLOCK_SIZE].astype(np.float32) @ query
+                for start in range(0, len(codes), self._SCORE_BLOCK_SIZE)
+            ])
+
+        num_candidates = min(len(codes), max(top_k, math.ceil(top_k * QUANTIZATION_OVERSAMPLING)))
+        candidates = np.argpartition(-approx, num_candidates - 1)[:num_candidates]
+
+        # Read the originals in storage order, which is cheaper on a memory map
+        candidates = candidates[np.argsort(collection.positions[candidates])]
+        originals = _normalize(collection.corpus.embeddings[collection.positions[candidates]])
+        exact = originals @ query
+
+        best = np.argsort(-exact)[:top_k]
+        return candidates[best], exact[best]